@@ -1,3 +1,9 @@
+import mmap, os, bisect, hashlib
+
+# The number of bytes to copy at once when a DataBlock is written to another
+# file
+COPY_CHUNK_SIZE = 1048576
+
 class DataBlock:
   """ General class for a data block on disk or in memory, which may be an Exif,
       IPTC, Photoshop, (...) element, but also a tag in one of these elements.
@@ -37,7 +43,11 @@ class DataBlock:
     """ Set the data of the tag to the specified binary string, along with a new
         offset. """
 
-    self.data        = buffer(data)
+    # Memory views can't be wrapped in a buffer, but can be sliced likewise
+    if (type(data) == memoryview):
+      self.data = data
+    else:
+      self.data = buffer(data)
     self.fp          = None
     self.data_offset = offset
     self.length      = length
@@ -49,7 +59,7 @@ class DataBlock:
     if (self.length):
       return self.length
     elif (self.data):
-      return len(self.data) - self.data_offset
+      return max(len(self.data) - self.data_offset, 0)
     else:
       return None
       
@@ -69,7 +79,7 @@ class DataBlock:
     # Read the bytes from file
     if (self.fp):
       if (num_bytes == None):
-        if (self.getDataLength()):
+        if (self.getDataLength() != None):
           num_bytes = self.getDataLength() - self.tell()
         else:
           num_bytes = -1
@@ -77,10 +87,13 @@ class DataBlock:
       
     # Read the bytes from buffer
     elif (self.data):
-      if (num_bytes == None) or ((num_bytes) and ((num_bytes - self.tell()) > self.getDataLength())):
-        num_bytes = self.getDataLength() - self.tell()
+      remaining = self.getDataLength() - self.tell()
+      if (num_bytes == None) or (num_bytes < 0) or (num_bytes > remaining):
+        num_bytes = remaining
 
       data = self.data[self.byte_pos:self.byte_pos + num_bytes]
+      if (type(data) == memoryview):
+        data = data.tobytes()
       
     # Update the byte position
     if (data):
@@ -103,6 +116,68 @@ class DataBlock:
     """ Return the data blob. """
     return self.read(seek = 0)
     
+  def writeTo(self, out_fp, chunk_size = COPY_CHUNK_SIZE):
+    """ Write the content of the data block to the open output file, without
+        reading it into memory as a whole. If both the data block and the
+        output are backed by real files and the OS supports it, the copying is
+        left to the kernel. Otherwise, the data is copied in chunks of at most
+        chunk_size bytes. """
+    
+    # Find out how much needs to be copied. If the length is unknown for a
+    # file, we copy up to the end of it.
+    length = self.getDataLength()
+    
+    # Try to let the kernel do the copying
+    copied = 0
+    if (self.fp) and (hasattr(os, "copy_file_range") or hasattr(os, "sendfile")):
+      try:
+        in_fd  = self.fp.fileno()
+        out_fd = out_fp.fileno()
+      except (AttributeError, IOError, ValueError):
+        # Not a real file, like a StringIO object
+        in_fd = None
+      if (in_fd != None):
+        if (length == None):
+          length = os.fstat(in_fd).st_size - self.data_offset
+        out_fp.flush()
+        copied = self.__copyInKernel__(in_fd, out_fd, length)
+        
+    # Copy whatever is left in chunks
+    self.seek(copied)
+    while (length == None) or (copied < length):
+      if (length == None):
+        num_bytes = chunk_size
+      else:
+        num_bytes = min(chunk_size, length - copied)
+      chunk = self.read(num_bytes)
+      if (not chunk):
+        break
+      out_fp.write(chunk)
+      copied += len(chunk)
+
+  def __copyInKernel__(self, in_fd, out_fd, length):
+    """ Copy length bytes of the data block from the file descriptor in_fd to
+        the current position of out_fd, using copy_file_range or sendfile.
+        Returns the number of bytes copied, which may be less than requested
+        when the kernel refused to copy. """
+
+    offset = self.data_offset
+    end    = self.data_offset + length
+    while (offset < end):
+      try:
+        if (hasattr(os, "copy_file_range")):
+          num_bytes = os.copy_file_range(in_fd, out_fd, end - offset, offset)
+        else:
+          num_bytes = os.sendfile(out_fd, in_fd, offset, end - offset)
+      except OSError:
+        # For example when copying between file systems on older kernels
+        break
+      if (num_bytes == 0):
+        break
+      offset += num_bytes
+      
+    return offset - self.data_offset
+    
   def getDataOffset(self):
     """ Return the offset in the file where the data can be found, or None
         if the data is user set. """
@@ -114,3 +189,100 @@ class DataBlock:
         data offset. """
     
     return self.byte_pos - self.data_offset
+
+class ChainedDataBlock(DataBlock):
+  """ A DataBlock which presents the contents of a list of DataBlocks as one
+      continuous block, without concatenating them. This is used for payloads
+      which are spread over multiple segments. Since it can be read and seeked
+      like a file, it can in turn be used as file pointer for other DataBlocks.
+  """
+  
+  def __init__(self, blocks):
+    """ Initialize with the list of DataBlocks, in order. """
+    
+    DataBlock.__init__(self)
+    
+    # Remember where each block starts in the chain, so we can quickly find the
+    # block for a position
+    self.blocks = blocks
+    self.starts = []
+    self.length = 0
+    for block in blocks:
+      self.starts.append(self.length)
+      self.length += block.getDataLength()
+      
+  def getDataLength(self):
+    """ Return the total length of the chained blocks. """
+    
+    return self.length
+    
+  def read(self, num_bytes = None, seek = None):
+    """ Read the specified number of bytes, or up to the end if num_bytes is
+        None or negative, optionally after seeking to the specified position.
+    """
+    
+    if (seek != None):
+      self.seek(seek)
+      
+    # Don't read past the end
+    remaining = self.length - self.byte_pos
+    if (num_bytes == None) or (num_bytes < 0) or (num_bytes > remaining):
+      num_bytes = remaining
+      
+    # Collect the data from each block we pass
+    parts      = []
+    block_num  = bisect.bisect_right(self.starts, self.byte_pos) - 1
+    while (num_bytes > 0):
+      block      = self.blocks[block_num]
+      block_pos  = self.byte_pos - self.starts[block_num]
+      part       = block.read(min(num_bytes, block.getDataLength() - block_pos), block_pos)
+      parts.append(part)
+      self.byte_pos += len(part)
+      num_bytes     -= len(part)
+      block_num     += 1
+      
+    return "".join(parts)
+    
+  def seek(self, position):
+    """ Sets the byte position to the specified position. """
+    
+    if (position > self.length):
+      raise IOError, "Trying to seek outside data block."
+    self.byte_pos = position
+    
+class DigestWriter:
+  """ A writable file-like object which passes everything written to it on to
+      another one, while calculating a hashlib digest of it. Since it has no
+      file descriptor, DataBlock.writeTo() copies through it in chunks. """
+      
+  def __init__(self, out_fp, algorithm = "sha1"):
+    self.out_fp = out_fp
+    self.digest = hashlib.new(algorithm)
+    
+  def write(self, data):
+    self.digest.update(data)
+    self.out_fp.write(data)
+    
+  def flush(self):
+    if (hasattr(self.out_fp, "flush")):
+      self.out_fp.flush()
+      
+  def hexdigest(self):
+    """ Return the digest of the data written so far as a hex string. """
+    
+    return self.digest.hexdigest()
+    
+def mapFile(file_path):
+  """ Map the file at the specified path read-only into memory, and return it as
+      a buffer which can be used as the data for DataBlocks. Reading from such a
+      DataBlock slices the mapping directly, so no seeking and reading on the
+      file is done for each individual field. """
+
+  fp = open(file_path, "rb")
+  try:
+    mapping = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+  finally:
+    # The mapping stays valid after the file is closed
+    fp.close()
+
+  return buffer(mapping)
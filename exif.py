@@ -17,17 +17,20 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 # 
 
-import metainfofile, ifd, qdb, makernote, datablock
+# Import standard Python modules
+import types
+# Import custom modules
+import metainfofile, ifd, qdb, makernote, datablock, byteform
 
 # The Tiff IFD (first part off IFD0 in Tiff file).
 class TiffIFD(ifd.IFD):
   tags = qdb.QDB()
   # This info is taken from the Exif 2.2 specification, page 54
-  tags.addList("name",      ["ImageWidth", "ImageLength", "BitsPerSample", "Compression", "PhotometricInterpretation", "ImageDescription", "Make", "Model", "StripOffsets", "Orientation", "SamplesPerPixel", "RowsPerStrip", "StripByteCounts", "XResolution", "YResolution", "PlanarConfiguration", "ResolutionUnit", "TransferFunction", "Software", "DateTime", "Artist", "WhitePoint", "PrimaryChromaticities", "JPEGInterchangeFormat", "JPEGInterchangeFormatLength", "YCbCrCoefficients", "YCbCrSubSampling", "YCbCrPositioning", "ReferenceBlackWhite", "IPTC-NAA", "Copyright", "Exif IFD Pointer", "GPSInfo IFD Pointer"])
-  tags.addList("num",       [256, 257, 258, 259, 262, 270, 271, 272, 273, 274, 277, 278, 279, 282, 283, 284, 296, 301, 305, 306, 315, 318, 319, 513, 514, 529, 530, 531, 532, 33723, 33432, 34665, 34853])
-  tags.addList("data_type", [[3, 4], [3, 4], 3, 3, 3, 2,     2,     2,     [3, 4], 3, 3, [3, 4], [3, 4], 5, 5, 3, 3, 3,  2,     2,  2,     5, 5, 4, 4, 5, 3, 3, 5, 7, 2,     4, 4])
+  tags.addList("name",      ["ImageWidth", "ImageLength", "BitsPerSample", "Compression", "PhotometricInterpretation", "ImageDescription", "Make", "Model", "StripOffsets", "Orientation", "SamplesPerPixel", "RowsPerStrip", "StripByteCounts", "XResolution", "YResolution", "PlanarConfiguration", "ResolutionUnit", "TransferFunction", "Software", "DateTime", "Artist", "WhitePoint", "PrimaryChromaticities", "JPEGInterchangeFormat", "JPEGInterchangeFormatLength", "YCbCrCoefficients", "YCbCrSubSampling", "YCbCrPositioning", "ReferenceBlackWhite", "IPTC-NAA", "Copyright", "Exif IFD Pointer", "GPSInfo IFD Pointer", "SubIFDs"])
+  tags.addList("num",       [256, 257, 258, 259, 262, 270, 271, 272, 273, 274, 277, 278, 279, 282, 283, 284, 296, 301, 305, 306, 315, 318, 319, 513, 514, 529, 530, 531, 532, 33723, 33432, 34665, 34853, 330])
+  tags.addList("data_type", [[3, 4], [3, 4], 3, 3, 3, 2,     2,     2,     [3, 4], 3, 3, [3, 4], [3, 4], 5, 5, 3, 3, 3,  2,     2,  2,     5, 5, 4, 4, 5, 3, 3, 5, 7, 2,     4, 4, [4, 13]])
   # -1 means special, False means any.
-  tags.addList("count",     [1,      1,      3, 1, 1, False, False, False, -1,     1, 1, 1,      -1,     1, 1, 1, 1, -1, False, 19, False, 2, 6, 1, 1, 3, 2, 1, 6, False, False, 1, 1])
+  tags.addList("count",     [1,      1,      3, 1, 1, False, False, False, -1,     1, 1, 1,      -1,     1, 1, 1, 1, -1, False, 19, False, 2, 6, 1, 1, 3, 2, 1, 6, False, False, 1, 1, False])
   #  required = [256, 257, 258, 259, 262, 273, 277, 278, 279, 282, 283, 296, 34665]
 
 class ExifIFD(ifd.IFD):
@@ -68,15 +71,38 @@ MAKERNOTES = {
   "Panasonic":      makernote.PanasonicIFD
 }
 
+# The classes of the records, except for the makernote, which depends on the
+# camera make
+RECORD_CLASSES = {
+  1: TiffIFD,
+  2: ExifIFD,
+  3: GPSIFD,
+  4: InteropIFD,
+  6: TiffIFD
+}
+
+# The tags pointing to other IFD's or to the thumbnail, which are set for the
+# layout when the structure is encoded, per record number
+POINTER_TAGS = {
+  1: [34665, 34853, 330],
+  2: [37500, 40965],
+  6: [513]
+}
+
 class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):    
   """ Read and write an Exif segment in a file. """
   
-  def __init__(self, ifd_offset = 0, header_offset = 0, fp = None, length = None, data = None, big_endian = True):
+  def __init__(self, ifd_offset = 0, header_offset = 0, fp = None, length = None, data = None, big_endian = True, budget = None):
     """ Initialize the Exif data with the ifd_offset of the IFD in the 
         containing structure (like the segment), the header_offset to the
         containing structure in the file or data buffer, pointer to an open
         file of data buffer, and optionally the length of the actual data. The
         big_endian parameter specifies whther the data is in big endian format.
+        The optional budget is an ifd.ParseBudget with the limits for parsing
+        all IFD's; by default, the limits in the ifd module are used. When a
+        limit is exceeded, or the IFD's point to each other in a loop, an
+        ifd.ParseLimitError is raised, except for the makernote, which is then
+        left empty.
     """
     
     # We save both the header offset (to the containing structure) and the
@@ -87,6 +113,9 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
     self.ifd_offset    = ifd_offset
     self.header_offset = header_offset
     self.big_endian    = big_endian
+    self.budget        = budget
+    if (self.budget == None):
+      self.budget = ifd.ParseBudget()
 
     # Call the DataBlock constructor
     datablock.DataBlock.__init__(self, fp = fp, offset = header_offset, data = data)
@@ -99,6 +128,12 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
     self.records.addList("name", ["tiff", "exif", "gps", "interop", "makernote", "ifd1"])
     # The individual IFD's. None means not loaded.
     self.records.addList("record", [None, None, None, None, None, None])
+    
+    # The SubIFD's of the Tiff IFD (as used by DNG and many raw formats) aren't
+    # records, since there may be any number of them. Each SubIFD may point to
+    # a next IFD, forming a chain. They are loaded on request, and the loaded
+    # part of each chain is stored here by its index in the SubIFDs tag.
+    self.sub_ifds = {}
 
   def getRecord(self, rec_num):
     """ Returns the record object with the requested number. If its not loaded
@@ -112,7 +147,7 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
     if (rec_obj == None):
       # Load Tiff
       if (rec_num == 1):
-        rec_obj = TiffIFD(self.fp, self.ifd_offset, self.header_offset, self.data, big_endian = self.big_endian)
+        rec_obj = TiffIFD(self.fp, self.ifd_offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)
         
       elif (rec_num in [2, 3, 5, 6]):
         # For Exif, GPS, Makernote and IFD1, the Tiff structure is needed
@@ -120,17 +155,17 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
         
         # Exif
         if (rec_num == 2):
-          offset = tiff.getTag(34665)
+          offset = self.__getPointer__(tiff, 34665)
           if (offset):
-            rec_obj = ExifIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian)
+            rec_obj = ExifIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)
           else:
             rec_obj = ExifIFD(big_endian = self.big_endian)
         
         # GPS
         elif (rec_num == 3):
-          offset = tiff.getTag(34853)
+          offset = self.__getPointer__(tiff, 34853)
           if (offset):
-            rec_obj = GPSIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian)
+            rec_obj = GPSIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)
           else:
             rec_obj = GPSIFD(big_endian = self.big_endian)
 
@@ -149,9 +184,11 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
                 # but the actual data, so we have to manually retrieve the offset and
                 # compensate for the header offset.
                 makernote_offset = exif.fields[37500].getDataOffset() - self.header_offset
+                # Try to construct the makernote. Its data is often not a real
+                # IFD, so if it can't be parsed, or exceeds the parse limits,
+                # an empty makernote is used instead.
                 try:
-                  # Try to construct the makernote
-                  rec_obj = MAKERNOTES[make](self.fp, makernote_offset, self.header_offset, self.data, big_endian = self.big_endian)
+                  rec_obj = MAKERNOTES[make](self.fp, makernote_offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)
                 except:
                   pass
               if not (rec_obj):
@@ -161,16 +198,16 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
         elif (rec_num == 6):
           ifd1_offset = tiff.next_ifd_offset
           if (ifd1_offset):
-            rec_obj = TiffIFD(self.fp, ifd1_offset, self.header_offset, self.data, big_endian = self.big_endian)
+            rec_obj = TiffIFD(self.fp, ifd1_offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)
           else:
             rec_obj = TiffIFD(big_endian = self.big_endian)
 
       # Interop
       elif (rec_num == 4):
         exif = self.getRecord(2)
-        offset = exif.getTag(40965)
+        offset = self.__getPointer__(exif, 40965)
         if (offset):
-          rec_obj = InteropIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian)
+          rec_obj = InteropIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)
         else:
           rec_obj = InteropIFD(big_endian = self.big_endian)
       
@@ -180,23 +217,138 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
     # Return what we found or loaded
     return rec_obj
 
-  def getSize(self):
-    """ Return the total size of the encoded Exif blocks. """
+  def getRecordClass(self, rec_num):
+    """ Return the class of the record with the specified number without loading
+        it, so tag names can be resolved from the tag tables. The class of the
+        makernote is only known once it is loaded, so None is returned for it
+        until then. """
+        
+    rec_obj = self.records.query("num", rec_num, "record")
+    if (rec_obj != None):
+      return rec_obj.__class__
+    return RECORD_CLASSES.get(rec_num)
     
-    size = 0
+  def hasTags(self):
+    """ Returns True if any of the IFD's has tags set, or False otherwise. The
+        IFD's which aren't loaded yet aren't parsed for this. All other IFD's
+        are reached through the Tiff IFD, so if it isn't loaded, the number of
+        entries in its directory on disk tells whether there are any tags. """
+        
+    # Check the loaded records
+    for rec_obj in self.records.getList("record"):
+      if (rec_obj) and (rec_obj.hasTags()):
+        return True
+        
+    # If the Tiff IFD isn't loaded, read its number of entries and the pointer
+    # to IFD1 from disk
+    if (self.records.query("num", 1, "record") == None):
+      if not ((self.fp) or (self.data)):
+        return False
+      self.seek(self.ifd_offset)
+      num_entries = byteform.btousi(self.read(2) or "", big_endian = self.big_endian)
+      if (num_entries > 0):
+        return True
+      self.seek(self.ifd_offset + 2)
+      if (byteform.btousi(self.read(4) or "", big_endian = self.big_endian) == 0):
+        return False
+        
+    # Otherwise, we need to load the records
+    return metainfofile.MetaInfoBlock.hasTags(self)
     
-    # Query each record for the size
-    for record in self.records.getList("record"):
-      if (record) and (record.hasTags()):
-        size += record.getSize()
+  def getNumSubIFDs(self):
+    """ Return the number of SubIFD's the Tiff IFD points to. """
+    
+    return len(self.__getSubIFDOffsets__())
+    
+  def getSubIFD(self, index, position = 0):
+    """ Return the IFD at the specified position in the chain of the SubIFD
+        with the specified index in the SubIFDs tag of the Tiff IFD. The IFD's
+        of the chain up to this position are loaded from disk if needed, and an
+        IndexError is raised if the chain is shorter. Plain Exif reads never
+        load the SubIFD's, so they only cost time when requested. """
+        
+    if (index not in self.sub_ifds):
+      offset = self.__getSubIFDOffsets__()[index]
+      self.sub_ifds[index] = [TiffIFD(self.fp, offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget)]
       
-    return size
-  
-  def getBlob(self, offset = 0):
-    """ Return the encoded Tiff, Exif, GPS, and Interoperability IFD's as a
-        block. The offset specifies the offset that needs to be added to all
-        data offsets (usually this will be 8 bytes for the Tiff header). """
+    # Follow the next IFD pointers. The shared budget detects loops.
+    chain = self.sub_ifds[index]
+    while (len(chain) <= position):
+      next_offset = chain[-1].next_ifd_offset
+      if not (next_offset):
+        raise IndexError, "SubIFD %d has a chain of only %d IFD's" % (index, len(chain))
+      chain.append(TiffIFD(self.fp, next_offset, self.header_offset, self.data, big_endian = self.big_endian, budget = self.budget))
+      
+    return chain[position]
     
+  def getSubIFDChain(self, index):
+    """ Return a list with all IFD's in the chain of the SubIFD with the
+        specified index, loading them if needed. """
+        
+    chain = [self.getSubIFD(index)]
+    while (chain[-1].next_ifd_offset):
+      chain.append(self.getSubIFD(index, len(chain)))
+      
+    return chain
+    
+  def __getSubIFDOffsets__(self):
+    """ Return the list of offsets in the SubIFDs tag of the Tiff IFD. """
+    
+    offsets = self.getRecord(1).getTag(330)
+    if (type(offsets) in [types.IntType, types.LongType]):
+      return [offsets]
+    elif (type(offsets) == types.ListType):
+      return offsets
+    return []
+    
+  def __getPointer__(self, record, tag_num):
+    """ Return the offset stored in the pointer tag in the record, or None if
+        the tag is not present or doesn't hold a single number. """
+        
+    offset = record.getTag(tag_num)
+    if (type(offset) not in [types.IntType, types.LongType]):
+      return None
+    return offset
+    
+  def getSize(self, offset = 0):
+    """ Return the total size of the encoded Exif blocks, including the
+        thumbnail. The offset is the one which will be passed to getBlob, so
+        the pointers between the IFD's don't need to change in between. """
+    
+    saved  = self.__savePointers__()
+    layout = self.__planLayout__(offset)
+    self.__restorePointers__(saved)
+    return layout["end"] - offset
+    
+  def __savePointers__(self):
+    """ Return the current pointer tags, so they can be restored after they
+        were set for a new layout. This way, encoding the structure doesn't
+        change it, and it can be encoded again with the same result. """
+        
+    saved = []
+    for rec_num in POINTER_TAGS:
+      record = self.getRecord(rec_num)
+      for tag_num in POINTER_TAGS[rec_num]:
+        saved.append([record, tag_num, record.fields.get(tag_num)])
+        
+    return saved
+    
+  def __restorePointers__(self, saved):
+    """ Restore the pointer tags saved by __savePointers__. """
+    
+    for record, tag_num, tag in saved:
+      if (tag == None):
+        record.removeTag(tag_num)
+      else:
+        record.setTag(tag_num, check = False, data_type = tag.getDataType(), data = tag.getData())
+  
+  def __planLayout__(self, offset):
+    """ Decide which IFD's are written, set the tags pointing to them, and
+        return a dict with the offset of each IFD (or None if it isn't
+        written), of the thumbnail data, and of the end of the structure. The
+        sizes of the IFD's are only calculated again when they changed, so
+        planning again is cheap. """
+        
     # Retrieve the necessary IFD's
     tiff      = self.getRecord(1)
     exif      = self.getRecord(2)
@@ -208,7 +360,8 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
     # Decide whether the tags pointing to other IFD's should be present. As we
     # don't know the offsets yet, we simply set them to zero. This procedure is
     # needed so we can calcuate the proper size of each IFD (and hence, the
-    # offsets).
+    # offsets). Existing pointers are left alone, since their size doesn't
+    # change, and resetting them would make the IFD's change on every call.
     
     # Interopability and Makernote IFD's need to go first, since they are stored
     # in the Exif IFD, which may be empty or not depending on the presence of 
@@ -218,58 +371,98 @@ class Exif(metainfofile.MetaInfoBlock, datablock.DataBlock):
     else:
       exif.removeTag(37500)
     if (interop.hasTags()):
-      exif.setTag(40965, 0)
+      if (40965 not in exif.fields):
+        exif.setTag(40965, 0)
     else:
       exif.removeTag(40965)
 
     # Exif IFD
     if (exif.hasTags()):
-      tiff.setTag(34665, 0)
+      if (34665 not in tiff.fields):
+        tiff.setTag(34665, 0)
     else:
       tiff.removeTag(34665)
     
     # GPS IFD
     if (gps.hasTags()):
-      tiff.setTag(34853, 0) # Offset to GPS IFD
+      if (34853 not in tiff.fields):
+        tiff.setTag(34853, 0) # Offset to GPS IFD
     else:
       tiff.removeTag(34853)
 
-    ifd1_offset = 0
-    
     # Now that we can determine the size of each IFD, determine their offsets
-    # and store them in the appropriate tags.    
+    # and store them in the appropriate tags.
+    layout = {"tiff": offset, "exif": None, "gps": None, "interop": None, "sub_ifds": [], "ifd1": None, "thumbnail": None}
     curr_offset = offset + tiff.getSize()
     if (exif.hasTags()):
-      exif_offset = curr_offset
-      tiff.setTag(34665, exif_offset)
+      layout["exif"] = curr_offset
+      tiff.setTag(34665, curr_offset)
       curr_offset += exif.getSize()
     if (gps.hasTags()):
-      gps_offset = curr_offset
-      tiff.setTag(34853, gps_offset)
+      layout["gps"] = curr_offset
+      tiff.setTag(34853, curr_offset)
       curr_offset += gps.getSize()
     if (interop.hasTags()):
-      interop_offset = curr_offset
-      exif.setTag(40965, interop_offset)
+      layout["interop"] = curr_offset
+      exif.setTag(40965, curr_offset)
       curr_offset += interop.getSize()
+    for index in range(self.getNumSubIFDs()):
+      chain_offsets = []
+      for sub_ifd in self.getSubIFDChain(index):
+        chain_offsets.append(curr_offset)
+        curr_offset += sub_ifd.getSize()
+      layout["sub_ifds"].append(chain_offsets)
+    if (len(layout["sub_ifds"]) > 0):
+      tiff.setTag(330, [chain_offsets[0] for chain_offsets in layout["sub_ifds"]])
     if (ifd1.hasTags()):
-      ifd1_offset = curr_offset
-      thumbnail_offset = curr_offset + ifd1.getSize()
-      tn_data = self.getThumbnail() # Let's load this before we start messing with the ifd
-      ifd1.setTag(513, thumbnail_offset)
-      
-    # Write the Exif IFD's
-    byte_str = tiff.getBlob(offset, ifd1_offset)
-    if (exif.hasTags()):
-      byte_str += exif.getBlob(exif_offset)
-    if (gps.hasTags()):
-      byte_str += gps.getBlob(gps_offset)
-    if (interop.hasTags()):
-      byte_str += interop.getBlob(interop_offset)
+      layout["ifd1"]      = curr_offset
+      layout["thumbnail"] = curr_offset + ifd1.getSize()
+      curr_offset = layout["thumbnail"]
+      thumbnail_length = ifd1.getTag(514) # JPEGInterchangeFormatLength
+      if (thumbnail_length):
+        curr_offset += thumbnail_length
+    layout["end"] = curr_offset
+    
+    return layout
+    
+  def getBlob(self, offset = 0):
+    """ Return the encoded Tiff, Exif, GPS, and Interoperability IFD's as a
+        block. The offset specifies the offset that needs to be added to all
+        data offsets (usually this will be 8 bytes for the Tiff header). """
+    
+    # Load the thumbnail and save the pointers before we start messing with the
+    # IFD's
+    ifd1 = self.getRecord(6)
     if (ifd1.hasTags()):
-      byte_str += ifd1.getBlob(ifd1_offset)
-      byte_str += tn_data
+      tn_data = self.getThumbnail()
+    saved = self.__savePointers__()
+      
+    # Plan the layout, and write the Exif IFD's in one go
+    layout = self.__planLayout__(offset)
+    if (layout["ifd1"] != None):
+      ifd1.setTag(513, layout["thumbnail"])
+      blobs = [self.getRecord(1).getBlob(offset, layout["ifd1"])]
+    else:
+      blobs = [self.getRecord(1).getBlob(offset, 0)]
+    for rec_num, name in [[2, "exif"], [3, "gps"], [4, "interop"]]:
+      if (layout[name] != None):
+        blobs.append(self.getRecord(rec_num).getBlob(layout[name]))
+    for index in range(len(layout["sub_ifds"])):
+      # Each IFD in a chain points to the next one which is written
+      chain   = self.getSubIFDChain(index)
+      written = [position for position in range(len(chain)) if (chain[position].hasTags())]
+      for written_num in range(len(written)):
+        position = written[written_num]
+        next_ifd = 0
+        if (written_num + 1 < len(written)):
+          next_ifd = layout["sub_ifds"][index][written[written_num + 1]]
+        blobs.append(chain[position].getBlob(layout["sub_ifds"][index][position], next_ifd))
+    if (layout["ifd1"] != None):
+      blobs.append(ifd1.getBlob(layout["ifd1"]))
+      blobs.append(tn_data)
+    self.__restorePointers__(saved)
 
-    return byte_str
+    return "".join(blobs)
 
   def getThumbnail(self):
     """ Return the thumbnail stored in the Exif structure, or None if it's
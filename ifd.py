@@ -18,7 +18,7 @@
 # 
 
 # Import standard Python modules
-import types
+import types, struct, array, bisect
 # Import custom modules
 import byteform, datablock, datatypes, metainfofile
 
@@ -76,10 +76,91 @@ DATA_TYPES = {
   9: datatypes.SLong,
   10: datatypes.SRational,
   11: datatypes.Float,
-  12: datatypes.Double
+  12: datatypes.Double,
+  13: datatypes.Long  # IFD offsets, from the Tiff 6.0 supplement
 } 
 
 # === Stuff relating to the IFD structure ===
+
+# The default limits for parsing a structure of IFD's: the number of IFD's,
+# the number of entries in a single IFD, and the total number of bytes the
+# entries may refer to.
+MAX_IFDS             = 32
+MAX_IFD_ENTRIES      = 4096
+MAX_REFERENCED_BYTES = 67108864
+
+class ParseLimitError(IOError):
+  """ Raised when parsing IFD's exceeds the parsing budget, or when an IFD is
+      referenced more than once (which means the IFD's point to each other in
+      a loop). """
+  pass
+  
+class ParseBudget:
+  """ Keeps track of the resources used while parsing a structure of IFD's,
+      which may be shared between all IFD's in the structure. A ParseLimitError
+      is raised as soon as a limit is exceeded. Limits which are not specified
+      are taken from the module defaults. """
+      
+  def __init__(self, max_ifds = None, max_entries = None, max_bytes = None):
+    if (max_ifds == None):
+      max_ifds = MAX_IFDS
+    if (max_entries == None):
+      max_entries = MAX_IFD_ENTRIES
+    if (max_bytes == None):
+      max_bytes = MAX_REFERENCED_BYTES
+    self.max_ifds    = max_ifds
+    self.max_entries = max_entries
+    self.max_bytes   = max_bytes
+    
+    # The absolute offsets of the IFD's parsed so far, and the number of bytes
+    # their entries refer to
+    self.visited   = set()
+    self.num_bytes = 0
+    
+  def claimIFD(self, offset, num_entries):
+    """ Register the IFD at the absolute offset with the specified number of
+        entries, before it is parsed. """
+        
+    if (offset in self.visited):
+      raise ParseLimitError, "IFD at offset %d is referenced more than once!" % offset
+    if (len(self.visited) >= self.max_ifds):
+      raise ParseLimitError, "More than %d IFD's found!" % self.max_ifds
+    if (num_entries > self.max_entries):
+      raise ParseLimitError, "IFD at offset %d has %d entries, more than the maximum of %d!" % (offset, num_entries, self.max_entries)
+    self.visited.add(offset)
+    
+  def claimBytes(self, num_bytes):
+    """ Register the number of bytes the entries of an IFD refer to. """
+    
+    self.num_bytes += num_bytes
+    if (self.num_bytes > self.max_bytes):
+      raise ParseLimitError, "IFD entries refer to more than %d bytes!" % self.max_bytes
+
+# Each IFD entry holds the tag number, data type, data count, and four bytes
+# with either the payload or an offset to it. The structs decode these entries
+# (and the pointer to the next IFD) for both byte orders.
+ENTRY_STRUCTS = {
+  True:  struct.Struct(">HHLL"),
+  False: struct.Struct("<HHLL")
+}
+POINTER_STRUCTS = {
+  True:  struct.Struct(">L"),
+  False: struct.Struct("<L")
+}
+# The first eight bytes of an entry, without the payload or offset
+ENTRY_HEADER_STRUCTS = {
+  True:  struct.Struct(">HHL"),
+  False: struct.Struct("<HHL")
+}
+
+# When reading the data of unchanged fields from disk, ranges which are at
+# most this many bytes apart are read at once
+MERGE_GAP = 16
+
+# When reading a batch of requested tags, ranges may be further apart, since
+# reading a few hundred bytes too much is cheaper than seeking again
+BATCH_MERGE_GAP = 512
+
 class Tag(datablock.DataBlock):
   """ An IFD tag. It is basically a DataBlock with a data type associated, since
       IFD tags may sometimes be encoded with differing data types. """
@@ -97,6 +178,151 @@ class Tag(datablock.DataBlock):
     """ Return the data type of the tag. """
     return self.data_type
       
+class FieldStore:
+  """ A compact store for the fields of an IFD, which behaves like a dict
+      coupling tag numbers to Tag objects. The fields read from disk are kept
+      in parallel arrays with the tag numbers (sorted), data types, byte
+      lengths and absolute offsets, and a Tag object is only created when a
+      field is requested. Fields set by the user are kept as Tag objects, and
+      override the ones from disk. """
+      
+  def __init__(self, fp = None, data = None):
+    """ Initialize an empty store for fields from the file pointer or data
+        buffer. """
+        
+    self.fp   = fp
+    self.data = data
+    
+    # The columns with the fields from disk
+    self.nums    = array.array("H")
+    self.types   = array.array("H")
+    self.lengths = array.array("L")
+    self.offsets = array.array("L")
+    
+    # The fields set or removed by the user, where removed fields are None
+    self.changed = {}
+    
+  def setDiskFields(self, entries):
+    """ Store the fields from disk, specified as list of [tag number, data
+        type, byte length, offset] entries. If a tag number occurs more than
+        once, the last entry is used. """
+        
+    # IFD entries should be sorted, but we can't count on it
+    nums = [entry[0] for entry in entries]
+    if (nums != sorted(set(nums))):
+      unique = {}
+      for entry in entries:
+        unique[entry[0]] = entry
+      entries = [unique[tag_num] for tag_num in sorted(unique.keys())]
+      
+    self.nums    = array.array("H", [entry[0] for entry in entries])
+    self.types   = array.array("H", [entry[1] for entry in entries])
+    self.lengths = array.array("L", [entry[2] for entry in entries])
+    self.offsets = array.array("L", [entry[3] for entry in entries])
+    self.changed = {}
+    
+  def getDataLength(self, tag_num):
+    """ Return the length of the data of the field, without creating a Tag
+        object for it. """
+        
+    if (tag_num in self.changed):
+      return self[tag_num].getDataLength()
+    index = self.__findDiskField__(tag_num)
+    if (index < 0):
+      raise KeyError, tag_num
+    return int(self.lengths[index])
+    
+  def readDiskData(self, tag_nums = None, gap = MERGE_GAP):
+    """ Return a dict coupling the tag numbers of the unchanged fields from
+        disk to their data type and raw data. If tag_nums is specified, only
+        these fields are read. The data is read in as few reads as possible, by
+        merging ranges which are at most gap bytes apart. """
+        
+    indices = [index for index in range(len(self.nums)) if (self.nums[index] not in self.changed)]
+    if (tag_nums != None):
+      tag_nums = set(tag_nums)
+      indices  = [index for index in indices if (self.nums[index] in tag_nums)]
+    indices.sort(key = lambda index: self.offsets[index])
+    
+    # Group the fields in runs of ranges which can be read at once
+    runs = []
+    for index in indices:
+      start = self.offsets[index]
+      end   = start + self.lengths[index]
+      if (len(runs) > 0) and (start <= runs[-1][1] + gap):
+        runs[-1][1] = max(runs[-1][1], end)
+        runs[-1][2].append(index)
+      else:
+        runs.append([start, end, [index]])
+        
+    # Read each run, and cut out the data of the fields
+    disk_data = {}
+    for start, end, run_indices in runs:
+      block = datablock.DataBlock(fp = self.fp, data = self.data, offset = int(start), length = int(end - start))
+      chunk = block.read(int(end - start)) or ""
+      for index in run_indices:
+        field_start = self.offsets[index] - start
+        disk_data[self.nums[index]] = [self.types[index], chunk[field_start:field_start + self.lengths[index]]]
+        
+    return disk_data
+    
+  def __findDiskField__(self, tag_num):
+    """ Return the index of the tag number in the disk fields, or -1. """
+    
+    index = bisect.bisect_left(self.nums, tag_num)
+    if (index < len(self.nums)) and (self.nums[index] == tag_num):
+      return index
+    return -1
+    
+  def __getitem__(self, tag_num):
+    if (tag_num in self.changed):
+      tag = self.changed[tag_num]
+      if (tag == None):
+        raise KeyError, tag_num
+      return tag
+      
+    index = self.__findDiskField__(tag_num)
+    if (index < 0):
+      raise KeyError, tag_num
+    return Tag(self.types[index], fp = self.fp, data = self.data, offset = int(self.offsets[index]), length = int(self.lengths[index]))
+    
+  def __setitem__(self, tag_num, tag):
+    self.changed[tag_num] = tag
+    
+  def __delitem__(self, tag_num):
+    if (tag_num not in self):
+      raise KeyError, tag_num
+    self.changed[tag_num] = None
+    
+  def __contains__(self, tag_num):
+    if (tag_num in self.changed):
+      return (self.changed[tag_num] != None)
+    return (self.__findDiskField__(tag_num) >= 0)
+    
+  def get(self, tag_num, default = None):
+    if (tag_num in self):
+      return self[tag_num]
+    return default
+    
+  def keys(self):
+    """ Return a list of the tag numbers in the store. """
+    
+    tag_nums = [tag_num for tag_num in self.nums if (tag_num not in self.changed)]
+    for tag_num in self.changed:
+      if (self.changed[tag_num] != None):
+        tag_nums.append(tag_num)
+        
+    return tag_nums
+    
+  def items(self):
+    return [(tag_num, self[tag_num]) for tag_num in self.keys()]
+    
+  def __iter__(self):
+    return iter(self.keys())
+    
+  def __len__(self):
+    return len(self.keys())
+    
 class IFD(metainfofile.MetaInfoRecord):
   """ An IFD (Image File Directory) represents an elementary data type in both a
       Tiff and an Exif file. This class functions as a base class.
@@ -108,12 +334,14 @@ class IFD(metainfofile.MetaInfoRecord):
   # The data types we know of
   DATA_TYPES = DATA_TYPES
   
-  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = True):
+  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = True, budget = None):
     """ Initialize the IFD data with the ifd_offset of the IFD in the 
         containing structure (like the segment), the header_offset to the
         containing structure in the file or data buffer, and pointer to an open
         file of data buffer. The big_endian parameter specifies whther the data
-        is in big endian format.
+        is in big endian format. The optional budget is the ParseBudget shared
+        by the IFD's of the containing structure; if it is not given, the IFD
+        gets one of its own with the default limits.
     """
     
     # Construct the arguments for the base class
@@ -134,7 +362,21 @@ class IFD(metainfofile.MetaInfoRecord):
     self.ifd_offset    = ifd_offset
     self.header_offset = header_offset
     self.big_endian    = big_endian
-    self.fields        = {}
+    self.fields        = FieldStore(self.fp, self.data)
+    self.budget        = budget
+    if (self.budget == None):
+      self.budget = ParseBudget()
+    
+    # The payloads dict caches the decoded payload of each requested tag
+    self.payloads      = {}
+    
+    # The last encoded IFD, which can be reused as long as no tag is changed,
+    # and the numbers of the tags changed since it was encoded
+    self.encoded       = None
+    self.dirty         = set()
+    
+    # The size of the encoded IFD, which is calculated when first requested
+    self.size          = None
     
     # The last four bytes of the non-data part of an IFD store the pointer to
     # the next IFD.
@@ -146,45 +388,68 @@ class IFD(metainfofile.MetaInfoRecord):
    
   def mapDiskFields(self):
     """ Reads the exif structure from disk and maps all the fields. """
-    self.fields = {} # Empty the map
+    self.fields   = FieldStore(self.fp, self.data) # Empty the map
+    self.payloads = {}
+    self.encoded  = None
+    self.dirty    = set()
+    self.size     = None
     
     # Go to the proper offset and read the first two bytes. They represent the
     # number of fields in the IFD
     if (self.getDataLength() > 0) or (self.getDataLength() == None): # Parse when there's data, or when data size is unknown
       self.seek(self.ifd_offset)
       num_fields = byteform.btousi(self.read(2), big_endian = self.big_endian)
-  
+      self.budget.claimIFD(self.header_offset + self.ifd_offset, num_fields)
+      
+      # Read all field entries and the pointer to the next IFD at once. If the
+      # data ends early, we use the entries which are complete.
+      declared     = num_fields
+      directory    = self.read(12 * declared + 4) or ""
+      entry_struct = ENTRY_STRUCTS[bool(self.big_endian)]
+      num_fields   = min(declared, len(directory) // 12)
+      
+      # The absolute offset of the first entry in the file or data stream
+      entry_offset = self.header_offset + self.ifd_offset + 2
+      
+      entries   = []
+      num_bytes = 0
       for field_num in range(num_fields):
-        # Read the type of the tag (number), the way the payload is stored, and
-        # the length of the payload
-        tag_type    = byteform.btousi(self.read(2), big_endian = self.big_endian)
-        data_type   = byteform.btousi(self.read(2), big_endian = self.big_endian)
-        payload_len = byteform.btousi(self.read(4), big_endian = self.big_endian)
+        # Decode the type of the tag (number), the way the payload is stored,
+        # the length of the payload, and the payload or its offset
+        tag_type, data_type, payload_len, payload_ptr = entry_struct.unpack_from(directory, 12 * field_num)
   
         # The word width (number of bytes to encode one "character") of the
         # payload is determined by the data type. This needs to be multiplied by
         # the number of characters to get the total number of bytes.
-        num_bytes = payload_len * DATA_TYPES[data_type].word_width
+        field_bytes = payload_len * DATA_TYPES[data_type].word_width
           
-        # The next four bytes either encode an offset te where the payload can
+        # The last four bytes either encode an offset te where the payload can
         # be found, or the payload itself if it fits in these four bytes. We
         # calculate the absolute offset in the file or data stream.
-        if (num_bytes < 5):
-          payload_offset = self.tell() + self.header_offset
-          self.read(4)
+        if (field_bytes < 5):
+          payload_offset = entry_offset + 12 * field_num + 8
         else:
-          payload_offset = byteform.btousi(self.read(4), big_endian = self.big_endian) + self.header_offset# - self.ifd_offset
+          payload_offset = payload_ptr + self.header_offset
 
         # Store the tag. This method does not check if we know the tag type, and
         # that's exactly what we want.
-        tag = Tag(data_type, fp = self.fp, data = self.data, offset = payload_offset, length = num_bytes)
-        self.fields[tag_type] = tag
+        entries.append([tag_type, data_type, field_bytes, payload_offset])
+        num_bytes += field_bytes
         
-      self.next_ifd_offset = byteform.btoi(self.read(4), big_endian = self.big_endian)
+      self.budget.claimBytes(num_bytes)
+      self.fields.setDiskFields(entries)
+      # Only a complete directory has a pointer to the next IFD; otherwise the
+      # next IFD is treated as absent
+      if (len(directory) == 12 * declared + 4):
+        self.next_ifd_offset = POINTER_STRUCTS[bool(self.big_endian)].unpack_from(directory, 12 * declared)[0]
 
   def getTag(self, tag_num):
     """Returns the payload from a certain tag number. """
 
+    # Use the cached payload if the tag was decoded before
+    if (tag_num in self.payloads):
+      return self.__copyPayload__(self.payloads[tag_num])
+      
     if (tag_num in self.fields):
       tag = self.fields[tag_num]
     else:
@@ -192,19 +457,37 @@ class IFD(metainfofile.MetaInfoRecord):
       return False
 
     # Decipher the relevant info
-    data_type = tag.getDataType()
-    data      = tag.getData()
-    payload   = self.DATA_TYPES[data_type].decode(data, self.big_endian)
+    payload = self.__decodePayload__(tag.getDataType(), tag.getData())
+    self.payloads[tag_num] = payload
+      
+    return self.__copyPayload__(payload)
 
-    # If the tag is empty, return None. Else if data is a single value, return 
-    # it as such, otherwise, return a list
+  def getTags(self, tag_nums):
+    """ Return a list with the payloads of the specified tag numbers, like
+        getTag. The data of the tags which still need to be decoded is read
+        from disk in order of offset, in as few reads as possible. """
+        
+    # Read and decode the tags which aren't cached yet
+    pending   = [tag_num for tag_num in tag_nums if (tag_num not in self.payloads) and (tag_num in self.fields)]
+    disk_data = self.fields.readDiskData(pending, BATCH_MERGE_GAP)
+    for tag_num in disk_data:
+      data_type, data = disk_data[tag_num]
+      self.payloads[tag_num] = self.__decodePayload__(data_type, data)
+      
+    return [self.getTag(tag_num) for tag_num in tag_nums]
+    
+  def __decodePayload__(self, data_type, data):
+    """ Decode the data of a tag. If the tag is empty, return None. Else if
+        data is a single value, return it as such, otherwise, return a list. """
+        
+    payload = self.DATA_TYPES[data_type].decode(data, self.big_endian)
     if (len(payload) == 0):
-      return None
+      payload = None
     elif (len(payload) == 1):
-      return payload[0]
-    else:
-      return payload
-
+      payload = payload[0]
+      
+    return payload
+    
   def setTag(self, tag_num, payload = None, check = True, data_type = None, count = None, data = None):
     """ Sets the (unencoded) payload or (binary encoded) data for a certain tag 
         num or tag name. If check is False, the method doesn't check if it knows
@@ -226,7 +509,7 @@ class IFD(metainfofile.MetaInfoRecord):
       # Check for the correct parameters
       if (type(data) != types.StringType):
         raise TypeError, "IFD data should be a binary string"
-      if (type(data_types) != types.IntType):
+      if (type(data_type) != types.IntType):
         raise TypeError, "When setting an IFD tag directly with binary data, you need to specify exactly one data type"
     # Otherwise, encode the tag ourselve
     else:
@@ -265,23 +548,51 @@ class IFD(metainfofile.MetaInfoRecord):
       if (data == None):
         raise "Error encoding data for tag %d!" % tag_num
 
+    # If the tag doesn't actually change, we keep the old one, so the encoded
+    # IFD can be reused. Otherwise, we update the size of the IFD for the
+    # difference with the old tag, or for the new entry.
+    size_change = 12 + self.__getValueSize__(len(data))
+    if (tag_num in self.fields):
+      old_tag = self.fields[tag_num]
+      if (old_tag.getDataType() == data_type) and (old_tag.getDataLength() == len(data)) and (old_tag.getData() == data):
+        return
+      size_change -= 12 + self.__getValueSize__(old_tag.getDataLength())
+        
     # Set the used data type and payload
     self.fields[tag_num] = Tag(data_type, data = data)
+    self.dirty.add(tag_num)
+    if (self.size != None):
+      self.size += size_change
+    if (tag_num in self.payloads):
+      del(self.payloads[tag_num])
 
   def removeTag(self, tag_num):
     """ Remove tag with the specified number. """
-    try:
+    if (tag_num in self.payloads):
+      del(self.payloads[tag_num])
+    if (tag_num in self.fields):
+      if (self.size != None):
+        self.size -= 12 + self.__getValueSize__(self.fields.getDataLength(tag_num))
       del(self.fields[tag_num])
-    except KeyError:
-      pass
+      self.dirty.add(tag_num)
+      
+  def __getValueSize__(self, num_bytes):
+    """ Return the number of bytes a tag with num_bytes of data needs outside
+        its entry in the encoded IFD. """
+        
+    if (num_bytes > 4):
+      return num_bytes
+    return 0
     
   def getSize(self, next_ifd = True):
     """ Calculate the byte size of the
-    IFD. """
+    IFD. The size is remembered until a tag is changed. """
     
     if not (self.hasTags()):
       # If we don't have any tags, length is zero
       return 0
+    elif (self.size != None):
+      return self.size
     else:
       tag_nums = self.fields.keys()
       
@@ -297,32 +608,49 @@ class IFD(metainfofile.MetaInfoRecord):
       # For each field with a data block larger than four bytes, we need to add
       # the size of the data field
       for tag_num in tag_nums:
-        tag       = self.fields[tag_num]
-        num_bytes = tag.getDataLength()
+        num_bytes = self.fields.getDataLength(tag_num)
         if (num_bytes > 4):
           size += num_bytes
           
+      self.size = size
       return size
     
   def getBlob(self, offset, next_ifd = 0):
     """Returns the entry stream and the data stream for writing the IFD. offset
     is the offset to byte addresses specified in tghe IFD (usually the size of
     the TIFF header). next_ifd is the byte position for the next IFD, if any.
-    If next_ifd is set to None, it will be omitted
+    If next_ifd is set to None, it will be omitted.
+    The encoded IFD is kept. As long as no tags are changed, it is reused with
+    only its offsets relocated. Otherwise, the data of the unchanged tags is
+    copied from it, or read from disk in bulk the first time.
     """
     
     if not (self.hasTags()):
       # If we don't have any tags, simply return nothing
       return None
+    elif (self.encoded != None) and (len(self.dirty) == 0) and ((self.encoded[2] == None) == (next_ifd == None)):
+      return self.__relocateBlob__(offset, next_ifd)
     else:
-      tag_nums = self.getTagNums()
+      tag_nums     = self.getTagNums()
+      entry_struct = ENTRY_HEADER_STRUCTS[bool(self.big_endian)]
+      
+      # Find the data of the unchanged tags in the previous encoding, and read
+      # the rest of the unchanged tags from disk
+      old_blob  = ""
+      old_spans = {}
+      if (self.encoded != None):
+        old_blob  = self.encoded[0]
+        for tag_num in self.encoded[4]:
+          if (tag_num not in self.dirty):
+            old_spans[tag_num] = self.encoded[4][tag_num]
+      disk_data = self.fields.readDiskData([tag_num for tag_num in tag_nums if (tag_num not in old_spans)])
   
       # For writing the data, we split the stream in two; one part contains the
       # 12-byte fields specifying tags, data type, etc. and the other one contains
       # the encoded data (which is over 4 bytes in size). At the end, these two
       # fields will be concatenated
-      fields_stream = byteform.itob(len(tag_nums), 2, big_endian = self.big_endian)
-      data_stream = ""
+      fields_stream = [byteform.itob(len(tag_nums), 2, big_endian = self.big_endian)]
+      data_stream   = []
       
       # Calculate the offset at which we may write data (after the offset, 2
       # bytes at the start of the IFD and 12 bytes for each field
@@ -330,29 +658,64 @@ class IFD(metainfofile.MetaInfoRecord):
 
       # If we have a pointer to the next IFD, write it to the data stream
       if (next_ifd != None):
-        data_stream = byteform.itob(next_ifd, 4, big_endian = self.big_endian)
+        data_stream.append(byteform.itob(next_ifd, 4, big_endian = self.big_endian))
         data_offset += 4
+        
+      # Remember where the offsets to the data are written, so they can be
+      # relocated, and where the data of each tag is written, so it can be
+      # copied when the IFD is encoded again
+      positions = []
+      spans     = {}
 
       # Write each tag
-      for tag_num in tag_nums:
-        tag       = self.fields[tag_num]
-        data_type = tag.getDataType()
-        data      = tag.getData()
-        count     = len(data) / DATA_TYPES[data_type].word_width
+      for entry_num in range(len(tag_nums)):
+        tag_num = tag_nums[entry_num]
+        if (tag_num in old_spans):
+          data_type, start, length = old_spans[tag_num]
+          data = old_blob[start:start + length]
+        elif (tag_num in disk_data):
+          data_type, data = disk_data[tag_num]
+        else:
+          tag       = self.fields[tag_num]
+          data_type = tag.getDataType()
+          data      = tag.getData()
+        count = len(data) / DATA_TYPES[data_type].word_width
         
         # Write the tag number, data type and data count
-        fields_stream += byteform.itob(tag_num, 2, big_endian = self.big_endian)
-        fields_stream += byteform.itob(data_type, 2, big_endian = self.big_endian)
-        fields_stream += byteform.itob(count, 4, big_endian = self.big_endian)
+        fields_stream.append(entry_struct.pack(tag_num, data_type, count))
         
         # If we can fit the data into four bytes, do so, otherwise write it in
         # the data field and store the offset
         if (len(data) <= 4):
-          fields_stream += data
-          fields_stream += (4 - len(data)) * "\x00"
+          spans[tag_num] = [data_type, 2 + 12 * entry_num + 8, len(data)]
+          fields_stream.append(data + (4 - len(data)) * "\x00")
         else:
-          fields_stream += byteform.itob(data_offset, 4, big_endian = self.big_endian)
-          data_stream   += data
-          data_offset   += len(data)
+          spans[tag_num] = [data_type, data_offset - offset, len(data)]
+          positions.append(2 + 12 * entry_num + 8)
+          fields_stream.append(byteform.itob(data_offset, 4, big_endian = self.big_endian))
+          data_stream.append(data)
+          data_offset += len(data)
           
-      return fields_stream + data_stream
+      blob = "".join(fields_stream + data_stream)
+      self.encoded = [blob, offset, next_ifd, positions, spans]
+      self.dirty   = set()
+      return blob
+      
+  def __relocateBlob__(self, offset, next_ifd):
+    """ Return the last encoded IFD for the new offset and next IFD pointer,
+        by only changing the pointers in it. """
+        
+    blob, old_offset, old_next_ifd, positions, spans = self.encoded
+    if (offset == old_offset) and (next_ifd == old_next_ifd):
+      return blob
+      
+    pointer_struct = POINTER_STRUCTS[bool(self.big_endian)]
+    new_blob = bytearray(blob)
+    for position in positions:
+      pointer_struct.pack_into(new_blob, position, pointer_struct.unpack_from(blob, position)[0] + offset - old_offset)
+    if (next_ifd != None):
+      pointer_struct.pack_into(new_blob, 2 + 12 * len(spans), next_ifd)
+      
+    blob = str(new_blob)
+    self.encoded = [blob, offset, next_ifd, positions, spans]
+    return blob
@@ -80,6 +80,10 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
     # repeated.
     self.fields = {}
     
+    # The payloads dict caches the decoded payloads of each requested tag, per
+    # data type they were decoded with
+    self.payloads = {}
+    
     # Prepare the data for the base class
     if ("big_endian" in kwargs):
       self.big_endian = kwargs["big_endian"]
@@ -91,6 +95,10 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
   def getTag(self, tag_num, data_type = None):
     """Return the payload from a certain tag number."""
     
+    # Use the cached payload if the tag was decoded before
+    if (tag_num in self.payloads) and (data_type in self.payloads[tag_num]):
+      return self.__copyPayload__(self.payloads[tag_num][data_type])
+      
     if (tag_num in self.fields):
       tags = self.fields[tag_num]
     else:
@@ -98,6 +106,7 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
       return False
 
     # Get the data type
+    requested_type = data_type
     if not (data_type):
       index = self.tags.query("num", tag_num)
       if (index == False):
@@ -119,8 +128,9 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
     # If only a single tag was read, return only that value
     if (len(payload) == 1):
       payload = payload[0]
+    self.payloads.setdefault(tag_num, {})[requested_type] = payload
     
-    return payload
+    return self.__copyPayload__(payload)
 
   def setTag(self, tag_num, payload = None, check = True, data_type = None, count = None, data = None):
     """ Sets the payload for a certain tag num or tag name. If check is False,
@@ -130,6 +140,8 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
 
     # Set a list with only this tag
     self.fields[tag_num] = [self.__getTagObj__(tag_num, payload, check, data_type, count, data)]
+    if (tag_num in self.payloads):
+      del(self.payloads[tag_num])
 
   def appendTag(self, tag_num, payload = None, check = True, data_type = None, count = None, data = None):
     """ Appends a tag with the specified payload. for a certain tag num or tag 
@@ -144,6 +156,8 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
     # Otherwise, append the new tag object to the existing list
     else:
       self.fields[tag_num].append(self.__getTagObj__(tag_num, payload, check, data_type, count, data))
+      if (tag_num in self.payloads):
+        del(self.payloads[tag_num])
 
   def removeTag(self, tag_num):
     """ Remove tag with the specified number. """
@@ -152,6 +166,8 @@ class IPTCRecord(metainfofile.MetaInfoRecord):
     # list
     if self.tags.query("num", tag_num):
       self.fields[tag_num] = []
+      if (tag_num in self.payloads):
+        del(self.payloads[tag_num])
 
   def getBlob(self):
     """ Return a binary string representing the IPTC record. """
@@ -87,6 +87,19 @@ class IPTC(metainfofile.MetaInfoBlock, datablock.DataBlock):
     # Remember if we have already parsed the data
     self.parsed = False
 
+  @classmethod
+  def prepare(cls, tag, record = None, data_type = None):
+    """ Return a TagHandle for the tag, like MetaInfoBlock.prepare. The data
+        type of known tags is looked up now as well, so it doesn't need to be
+        found for each file. """
+        
+    block, record_num, tag_num = cls.__resolveForHandle__(tag, record)
+    if (data_type == None):
+      rec_class = block.getRecordClass(record_num)
+      data_type = rec_class.tags.query("num", tag_num, "data_type")
+      
+    return metainfofile.TagHandle(cls, record_num, tag_num, data_type)
+    
   def getRecord(self, rec_num):
     """ Return the record with the specified number. """
     
@@ -125,7 +138,7 @@ class IPTC(metainfofile.MetaInfoBlock, datablock.DataBlock):
         length = byteform.btousi(self.read(length_count), big_endian = self.big_endian)
 
       # Construct the tag and append it to the list
-      tag_obj = datablock.DataBlock(self.fp, self.tell() + self.getDataOffset(), length)
+      tag_obj = datablock.DataBlock(self.fp, self.tell() + self.getDataOffset(), length, self.data)
       record = self.records.query("num", record_num, "record")
       if (tag_type in record.fields):
         record.fields[tag_type].append(tag_obj)
@@ -18,9 +18,9 @@
 # 
 
 # Import the custom modules
-import exif, tiff, metainfofile, byteform, datablock, iptcnaa, photoshop, convenience
+import exif, tiff, metainfofile, byteform, datablock, iptcnaa, photoshop, mpf, convenience
 # Import standard Python modules
-import types
+import os, re, types
 
 # JPEG files are divided in several segments, each starting with \xff, followed
 # by a byte soecifying the segment, foloowed by two bytes specifying the length
@@ -38,6 +38,24 @@ SEGMENTS = ["APP0", "APP1", "APP2", "APP3", "APP4", "APP5", "APP6", "APP7",
             "APP8", "APP9", "APP10", "APP11", "APP12", "APP13", "APP14",
             "APP15", "COM", "DQT", "DHT", "DAC", "DRI"]
 
+# The maximum number of content bytes in a segment; the two byte length field
+# includes itself.
+MAX_SEGMENT_LENGTH = 65533
+
+# The default maximum number of bytes to scan from the start of the file while
+# looking for the image data, and the number of bytes to read at once when
+# searching for a marker in garbage data.
+MAX_SCAN_BYTES  = 67108864
+SCAN_CHUNK_SIZE = 4096
+
+# In the entropy coded image data, a 0xFF byte followed by anything but a
+# stuffed zero byte or another 0xFF (a fill byte) is a marker.
+MARKER_PATTERN = re.compile("\xff[^\x00\xff]")
+
+class JpegError(IOError):
+  """ Raised when the Jpeg structure is too corrupt to be parsed. """
+  pass
+
 # All segments and their numbers specified by the Jpeg spec
 SEG_NUMS = {
   "SOF0":  0xC0, # 192
@@ -105,6 +123,32 @@ SEG_NUMS = {
   "COM":   0xFE  # 254
 }
 
+# The segments which are removed by default when stripping the metadata from a
+# file.
+STRIP_SEGMENTS = ["APP1", "APP13", "COM"]
+
+# The file name extensions of files which are stripped when processing a
+# directory tree
+JPEG_EXTENSIONS = [".jpg", ".jpeg", ".jpe"]
+
+# Markers which stand on their own, without a length or content; RSTn, SOI and
+# TEM.
+STANDALONE_MARKERS = [SEG_NUMS["RST0"], SEG_NUMS["RST1"], SEG_NUMS["RST2"],
+                      SEG_NUMS["RST3"], SEG_NUMS["RST4"], SEG_NUMS["RST5"],
+                      SEG_NUMS["RST6"], SEG_NUMS["RST7"], SEG_NUMS["SOI"], 0x01]
+
+# The segments which mark the start of the image data; an SOF in the case of
+# normal and progressive Jpeg, and DHP in the case of hierarchical Jpeg
+IMAGE_START_SEGMENTS = [SEG_NUMS["SOF0"], SEG_NUMS["SOF1"], SEG_NUMS["SOF2"],
+                        SEG_NUMS["SOF3"], SEG_NUMS["SOF5"], SEG_NUMS["SOF6"],
+                        SEG_NUMS["SOF7"], SEG_NUMS["SOF9"], SEG_NUMS["SOF10"],
+                        SEG_NUMS["SOF11"], SEG_NUMS["SOF13"], SEG_NUMS["SOF14"],
+                        SEG_NUMS["SOF15"], SEG_NUMS["DHP"]]
+
+# The image start segments for progressive Jpeg
+PROGRESSIVE_SEGMENTS = [SEG_NUMS["SOF2"], SEG_NUMS["SOF6"], SEG_NUMS["SOF10"],
+                        SEG_NUMS["SOF14"]]
+
 class Segment(datablock.DataBlock):
   """ A class for managing JPEG segments. """
   
@@ -123,7 +167,7 @@ class Segment(datablock.DataBlock):
       # If we're initialized with a number, we assume all data is segment
       # content
       self.number = num
-      if (fp) and not (length):
+      if (fp) and (length == None):
         raise "You need to specify the segment length!"
         
     else:
@@ -157,6 +201,15 @@ class Segment(datablock.DataBlock):
   def getNumber(self):
     return self.number
     
+  def getDataLength(self):
+    """ Return the length of the segment content. Unlike other DataBlocks, a
+        segment may have a known length of zero. """
+        
+    if (self.length != None):
+      return self.length
+    else:
+      return datablock.DataBlock.getDataLength(self)
+    
   def getBlob(self):
     """ Return the complete segment, including headers. """
     
@@ -173,120 +226,748 @@ class Jpeg(metainfofile.MetaInfoFile):
   # JPEG files are always big endian
   big_endian = True
     
-  def __init__(self, file_indicator, offset = 0):
-    """Initialize a JPEG file object. It needs an open file object or a path to
-    a file on the disk. A byte offset may be given to the start of the JPEG
-    header."""
+  def __init__(self, file_indicator, offset = 0, use_mmap = False, max_scan = MAX_SCAN_BYTES):
+    """Initialize a JPEG file object. It needs an open file object, a path to
+    a file on the disk, or the file contents as buffer, bytearray or memoryview.
+    A byte offset may be given to the start of the JPEG header. If use_mmap is
+    True, a file is memory mapped and parsed from the mapping instead of by
+    reading from the file. max_scan is the maximum number of bytes that are
+    scanned for the start of the image data; a JpegError is raised when it is
+    exceeded.
+    The file object may also be a non-seekable stream, like a pipe, socket or
+    sys.stdin. In that case only the segments up to the image data are read
+    and kept in memory, and the rest of the stream is passed through by
+    writeFile or stripFile, which can therefore only be called once."""
     
     metainfofile.MetaInfoFile.__init__(self)
     
-    # Initialize the file pointer
-    if (type(file_indicator) == types.StringType):
-      self.fp = convenience.PersistentFileHandle(file_indicator, "rb")
-    elif isinstance(file_indicator, convenience.PersistentFileHandle):
-      self.fp = file_indicator
-    else:
-      raise "No valid file parameter given -- file path or file object needed." 
+    # Initialize the file pointer or data buffer
+    self.__openFile__(file_indicator, use_mmap, allow_stream = True)
     
     # Initialize values
-    self.comment      = None
-    self.iptc_segment = None
-    self.ps_info      = None
-    self.exif_segment = None
+    self.comment = None
     
     # For each segment of a certain type, we keep a list in the self.segments
     # dict.
     self.segments = {}
     for seg_type in SEGMENTS:
       self.segments[SEG_NUMS[seg_type]] = []
+      
+    # We also keep the segments read from the file in their original order
+    self.file_segments = []
     
-    # Also remember the segments were we found the Exif and IPTC data
-    self.exif_segment = None
-    self.iptc_segment = None
-    self.ps_info      = None
+    # Also remember the segments were we found the Exif and IPTC data. The
+    # Photoshop data holding the IPTC info may span multiple segments.
+    self.exif_segment  = None
+    self.iptc_segments = []
+    self.ps_info       = None
     
-    # Parse the header
+    # The Multi-Picture index is only loaded when requested
+    self.mpf = None
+    
+    # Parse the header. The offset to the image data is only known once all
+    # segments have been discovered.
+    self.offset            = offset
+    self.max_scan          = max_scan
     self.image_data_offset = None
+    self.walk_offset       = None
+    
+    # Streams are read up to the image data, and the header is parsed from
+    # memory
+    self.stream_passed = False
+    if (self.stream):
+      self.__bufferStream__(offset)
     self.parseFile(offset)
 
   def parseFile(self, offset):
-    is_jpeg = True
-    
+    """ Check the JPEG header at the specified offset, and prepare for
+        discovering the segments. The segments themselves are only discovered
+        when they are needed (see __walkSegments__). """
+        
     # Read the header
-    data = self.fp.read(2)
+    data = datablock.DataBlock(offset = offset, **self.__getDataSource__()).read(2)
     if (data != "\xff\xd8"):
-      is_jpeg = False
+      raise JpegError, "Not a Jpeg file!"
 
-    # Read the file
-    while (data != ""):
-      curr_offset = self.fp.tell()
-      segment = Segment(fp = self.fp, offset = curr_offset)
-      part_type = segment.getNumber()
+    # The first segment follows the header
+    self.walk_offset = offset + 2
+    
+  def __bufferStream__(self, offset):
+    """ Read the Jpeg header from the input stream, up to and including the
+        frame header at the start of the image data, and keep it in self.data,
+        so it can be parsed like any other buffer. The rest of the stream is
+        left unread. Since we can't look back in a stream, buffering stops at
+        the first byte which isn't a marker; the walker treats it as the end of
+        the file. """
+        
+    # The SOI marker is checked by parseFile
+    parts     = [self.__readStream__(offset + 2)]
+    num_bytes = len(parts[0])
+    if (parts[0][offset:] != "\xff\xd8"):
+      self.data = buffer(parts[0])
+      return
+      
+    while (True):
+      if (num_bytes - offset > self.max_scan):
+        raise JpegError, "No image data found in the first %d bytes!" % self.max_scan
+        
+      # Read the marker, skipping any fill bytes
+      marker = self.__readStream__(2)
+      parts.append(marker)
+      while (marker == "\xff\xff"):
+        marker = "\xff" + self.__readStream__(1)
+        parts.append(marker[1:])
+      num_bytes += len(marker)
+      if (len(marker) < 2) or (marker[0] != "\xff") or (marker[1] == "\x00"):
+        break
+        
+      # Stop at the end of the image, and step over markers without content
+      part_type = ord(marker[1])
+      if (part_type in [SEG_NUMS["SOS"], SEG_NUMS["EOI"]]):
+        break
+      if (part_type in STANDALONE_MARKERS):
+        continue
+        
+      # Read the length and the segment contents. The frame header at the
+      # start of the image data is included, so the image can be probed.
+      length_str = self.__readStream__(2)
+      parts.append(length_str)
+      if (len(length_str) < 2):
+        break
+      length = byteform.btousi(length_str, big_endian = self.big_endian) - 2
+      if (length > 0):
+        parts.append(self.__readStream__(length))
+      num_bytes += 2 + max(length, 0)
+      if (part_type in IMAGE_START_SEGMENTS):
+        break
+      
+    self.data = buffer("".join(parts))
+    
+  def __readStream__(self, num_bytes):
+    """ Read num_bytes from the input stream, or less if it ends first. """
+    
+    parts = []
+    while (num_bytes > 0):
+      chunk = self.stream.read(num_bytes)
+      if (not chunk):
+        break
+      parts.append(chunk)
+      num_bytes -= len(chunk)
+      
+    return "".join(parts)
+    
+  def __passStream__(self, out_fp):
+    """ Copy the unread part of the input stream, which holds the image data,
+        to the output. This can only be done once. """
+        
+    if (self.stream == None):
+      return
+    if (self.stream_passed):
+      raise JpegError, "The image data of the input stream was already written."
+    self.stream_passed = True
+    
+    chunk = self.stream.read(datablock.COPY_CHUNK_SIZE)
+    while (chunk):
+      out_fp.write(chunk)
+      chunk = self.stream.read(datablock.COPY_CHUNK_SIZE)
+      
+  def __walkSegments__(self, seg_num = None):
+    """ Discover the segments in the file until one with number seg_num is
+        found, and return it. If seg_num is None, or no such segment is found,
+        all segments up to the image data are discovered and None is returned.
+        Discovered segments are stored in self.segments, and each call
+        continues where the previous one stopped. """
+    
+    while (self.walk_offset != None):
+      segment = self.__walkSegment__()
+      if (segment) and (segment.getNumber() == seg_num):
+        return segment
+          
+    return None
+    
+  def __walkSegment__(self):
+    """ Discover the next segment in the file and return it, or return None if
+        the image data or the end of the file is reached. Fill bytes and
+        garbage between segments are skipped. If no image data is found within
+        max_scan bytes, a JpegError is raised. """
+        
+    source = self.__getDataSource__()
+    while (self.walk_offset != None):
+      if (self.walk_offset - self.offset > self.max_scan):
+        raise JpegError, "No image data found in the first %d bytes!" % self.max_scan
+        
+      # Read the marker and length. If we don't find a marker, we try to
+      # resynchronize on the next one.
+      curr_offset = self.walk_offset
+      header      = datablock.DataBlock(offset = curr_offset, **source).read(4)
+      if (len(header) < 2) or (header[0] != "\xff") or (header[1] in "\x00\xff"):
+        curr_offset = self.__findMarker__(curr_offset)
+        if (curr_offset == None):
+          break
+        header = datablock.DataBlock(offset = curr_offset, **source).read(4)
+      part_type = ord(header[1])
       
       # We read only until the start of the image data, which is at an SOF in
       # the case of normal and progressive Jpeg, and DHP in the case of 
       # hierarchical Jpeg
-      if (part_type in [SEG_NUMS["SOF0"], SEG_NUMS["SOF1"], SEG_NUMS["SOF2"],
-                        SEG_NUMS["SOF3"], SEG_NUMS["SOF5"], SEG_NUMS["SOF6"],
-                        SEG_NUMS["SOF7"], SEG_NUMS["SOF9"], SEG_NUMS["SOF10"],
-                        SEG_NUMS["SOF11"], SEG_NUMS["SOF13"], SEG_NUMS["SOF15"],
-                        SEG_NUMS["DHP"]]):
+      if (part_type in IMAGE_START_SEGMENTS):
         self.image_data_offset = curr_offset
+        self.walk_offset       = None
+        return None
+        
+      # Scan data or the end of the image before any frame means the file is
+      # broken. Markers without content can simply be skipped.
+      if (part_type in [SEG_NUMS["SOS"], SEG_NUMS["EOI"]]):
         break
+      if (part_type in STANDALONE_MARKERS):
+        self.walk_offset = curr_offset + 2
+        continue
         
-      # Otherwise, store the segment and seek to the next one.
-      # WARNING: the value needs to be absolute, because the Segment class does
-      # some file seeking too!
-      else:
+      # A truncated header means the file ended, and a length which can't even
+      # hold itself means we should look for the next marker
+      if (len(header) < 4):
+        break
+      length = byteform.btousi(header[2:4], big_endian = self.big_endian) - 2
+      if (length < 0):
+        self.walk_offset = curr_offset + 2
+        continue
+      self.walk_offset = curr_offset + 4 + length
+      
+      # Store the segment if we know how to handle it, otherwise skip it
+      if (part_type in self.segments):
+        segment = Segment(part_type, offset = curr_offset + 4, length = length, **source)
         self.segments[part_type].append(segment)
-        self.fp.seek(segment.getDataOffset() + segment.getDataLength()) 
+        self.file_segments.append(segment)
+        return segment
+      
+    # If we get here, the file ended before the image data
+    self.walk_offset = None
+    return None
+    
+  def __findMarker__(self, offset):
+    """ Search for the next marker at or after offset, skipping fill bytes and
+        garbage, and return its offset. None is returned if the end of the
+        file is reached, and a JpegError if we pass max_scan bytes. """
+        
+    block   = datablock.DataBlock(offset = offset, **self.__getDataSource__())
+    scanned = 0
+    while (True):
+      # Read one byte extra, to see what follows an 0xFF at the end
+      chunk = block.read(SCAN_CHUNK_SIZE + 1, scanned)
+      if (len(chunk) < 2):
+        return None
+        
+      # A marker is an 0xFF followed by anything but a stuffed zero or another
+      # 0xFF (which is a fill byte)
+      pos = chunk.find("\xff")
+      while (pos != -1) and (pos < len(chunk) - 1):
+        if (chunk[pos + 1] not in "\x00\xff"):
+          return offset + scanned + pos
+        pos = chunk.find("\xff", pos + 1)
+        
+      scanned += len(chunk) - 1
+      if (offset + scanned - self.offset > self.max_scan):
+        raise JpegError, "No image data found in the first %d bytes!" % self.max_scan
+        
+  def __iterSegments__(self, seg_num):
+    """ Iterate over all segments with the specified number. Segments which are
+        not yet discovered are only searched for when the already discovered
+        ones are exhausted, so breaking out of the iteration early avoids
+        reading the rest of the file. """
+        
+    index = 0
+    while (index < len(self.segments[seg_num])) or (self.__walkSegments__(seg_num)):
+      yield self.segments[seg_num][index]
+      index += 1
+      
+  def __getSegmentRun__(self, first_segment, marker):
+    """ Return a list with the first segment and the segments directly
+        following it in the file, which are of the same type and start with the
+        same marker string. This is how payloads too large for a single segment
+        are stored. """
+        
+    run   = [first_segment]
+    index = self.file_segments.index(first_segment) + 1
+    while (True):
+      # Discover the next segment if needed
+      if (index == len(self.file_segments)) and not (self.__walkSegment__()):
+        break
+      segment = self.file_segments[index]
+      if (segment.getNumber() != first_segment.getNumber()) or (segment.read(len(marker), 0) != marker):
+        break
+      run.append(segment)
+      index += 1
+      
+    return run
+    
+  def __getPayload__(self, segments, header_length):
+    """ Return a ChainedDataBlock with the contents of the segments, skipping
+        header_length bytes of header at the start of each segment. """
+        
+    source = self.__getDataSource__()
+    blocks = []
+    for segment in segments:
+      blocks.append(datablock.DataBlock(offset = segment.getDataOffset() + header_length, length = segment.getDataLength() - header_length, **source))
+      
+    return datablock.ChainedDataBlock(blocks)
+    
+  def probe(self):
+    """ Return a dict with the basic image properties, decoded from the SOF
+        header: width, height, components (the number of color components),
+        precision (bits per sample) and progressive (True or False).
+        Additionaly, orientation holds the Exif Orientation, or None if it is
+        not set. Only the segment headers up to the image data, the SOF header
+        and the Tiff IFD are read. If no SOF header is found, None is returned,
+        and if it is truncated, a JpegError is raised.
+    """
+    
+    # Find the start of the image data
+    self.__walkSegments__()
+    if (self.image_data_offset == None):
+      return None
+      
+    # The SOF header consists of one byte for the precision, two for the height,
+    # two for the width and one for the number of components.
+    sof    = Segment(offset = self.image_data_offset, **self.__getDataSource__())
+    header = sof.read(6, 0)
+    if (not header) or (len(header) < 6):
+      raise JpegError, "The SOF header is truncated."
+    info = {
+      "precision":   byteform.btousi(header[0], big_endian = self.big_endian),
+      "height":      byteform.btousi(header[1:3], big_endian = self.big_endian),
+      "width":       byteform.btousi(header[3:5], big_endian = self.big_endian),
+      "components":  byteform.btousi(header[5], big_endian = self.big_endian),
+      "progressive": (sof.getNumber() in PROGRESSIVE_SEGMENTS)
+    }
+    
+    # The orientation is in the Tiff IFD, which we have passed by now
+    orientation = self.getExifTag("Orientation", 1)
+    if (orientation is False):
+      orientation = None
+    info["orientation"] = orientation
+    
+    return info
+    
+  def checkIntegrity(self):
+    """ Check the structure of the image data, without decoding it. The markers
+        in the entropy coded data are found by searching for them in large
+        chunks. Returns a dict with the following keys:
+        - frame_offset:      the offset of the SOF header, or None if there is
+                             no image data
+        - scan_offsets:      a list with the offsets of the SOS headers
+        - restart_interval:  the last restart interval, or None if not set
+        - restarts:          the number of restart markers found
+        - expected_restarts: the number of restart markers there should be
+                             according to the frame and scan headers, or None
+                             if this can't be determined
+        - eoi_offset:        the offset of the EOI marker, or None if missing
+        - errors:            a list with descriptions of the problems found
+        - complete:          True if no problems were found
+    """
+    
+    report = {
+      "frame_offset":      None,
+      "scan_offsets":      [],
+      "restart_interval":  None,
+      "restarts":          0,
+      "expected_restarts": 0,
+      "eoi_offset":        None,
+      "errors":            []
+    }
+    
+    if (self.stream):
+      raise JpegError, "The image data of an input stream can't be checked."
+    self.__walkSegments__()
+    if (self.image_data_offset == None):
+      report["errors"].append("No image data found")
+      report["expected_restarts"] = None
+      report["complete"] = False
+      return report
+    report["frame_offset"] = self.image_data_offset
+    
+    # A DRI segment may come before the frame header as well. A DRI segment
+    # after it overrides this interval.
+    dri_segments = self.segments[SEG_NUMS["DRI"]]
+    if (len(dri_segments) > 0):
+      report["restart_interval"] = byteform.btousi(dri_segments[-1].read(2, 0), big_endian = self.big_endian)
+      
+    source = self.__getDataSource__()
+    frame  = None
+    offset = self.image_data_offset
+    while (report["eoi_offset"] == None):
+      # Read the next marker, and skip any garbage in front of it
+      header = datablock.DataBlock(offset = offset, **source).read(4)
+      if (len(header) < 2):
+        report["errors"].append("File truncated at offset %d, EOI missing" % offset)
+        break
+      if (header[0] != "\xff") or (header[1] in "\x00\xff"):
+        marker_offset = self.__findMarker__(offset)
+        if (marker_offset == None):
+          report["errors"].append("Garbage at offset %d up to the end of the file, EOI missing" % offset)
+          break
+        if (marker_offset - offset > 1) or (header[0] != "\xff"):
+          report["errors"].append("Garbage at offset %d" % offset)
+        offset = marker_offset
+        header = datablock.DataBlock(offset = offset, **source).read(4)
+      number = ord(header[1])
+      
+      # The end of the image
+      if (number == SEG_NUMS["EOI"]):
+        report["eoi_offset"] = offset
+        break
+      if (number in STANDALONE_MARKERS):
+        report["errors"].append("Unexpected marker 0x%02X at offset %d" % (number, offset))
+        offset += 2
+        continue
+        
+      # All other markers are followed by a length
+      if (len(header) < 4):
+        report["errors"].append("File truncated at offset %d, EOI missing" % offset)
+        break
+      length  = byteform.btousi(header[2:4], big_endian = self.big_endian)
+      segment = Segment(number, offset = offset + 4, length = length - 2, **source)
+      offset += 2 + length
+      
+      # Remember the frame and restart interval, which are needed to calculate
+      # the number of restart markers
+      if (number in IMAGE_START_SEGMENTS):
+        frame = self.__parseFrameHeader__(segment)
+      elif (number == SEG_NUMS["DRI"]):
+        report["restart_interval"] = byteform.btousi(segment.read(2, 0), big_endian = self.big_endian)
+        
+      # A scan header is followed by the entropy coded data
+      elif (number == SEG_NUMS["SOS"]):
+        report["scan_offsets"].append(offset - 2 - length)
+        
+        # Calculate the number of restart markers in this scan
+        expected = self.__getExpectedRestarts__(frame, segment, report["restart_interval"])
+        if (expected == None) or (report["expected_restarts"] == None):
+          report["expected_restarts"] = None
+        else:
+          report["expected_restarts"] += expected
+        
+        # Find the marker after the scan data, counting the restart markers
+        offset, restarts = self.__scanEntropyData__(offset, report["errors"])
+        report["restarts"] += restarts
+        if (offset == None):
+          report["errors"].append("Scan data truncated, EOI missing")
+          break
+        
+    # Compare the expected and actual layout
+    if (frame == None):
+      report["errors"].append("No valid frame header found")
+    if (len(report["scan_offsets"]) == 0):
+      report["errors"].append("No scans found")
+    if (report["expected_restarts"] != None) and (report["restarts"] != report["expected_restarts"]):
+      report["errors"].append("Found %d restart markers, expected %d" % (report["restarts"], report["expected_restarts"]))
+    report["complete"] = (len(report["errors"]) == 0)
+    
+    return report
+    
+  def __parseFrameHeader__(self, segment):
+    """ Parse the SOF segment, and return a dict with the image width and
+        height, and a dict of components, where each component id is coupled
+        to its horizontal and vertical sampling factors. """
+        
+    data = segment.getData()
+    frame = {
+      "height":     byteform.btousi(data[1:3], big_endian = self.big_endian),
+      "width":      byteform.btousi(data[3:5], big_endian = self.big_endian),
+      "components": {}
+    }
+    for comp_offset in range(6, len(data) - 2, 3):
+      sampling = ord(data[comp_offset + 1])
+      frame["components"][ord(data[comp_offset])] = [sampling >> 4, sampling & 15]
+      
+    return frame
+    
+  def __getExpectedRestarts__(self, frame, scan_segment, restart_interval):
+    """ Return the number of restart markers the scan should contain, or None
+        if it can't be determined. """
+        
+    if not (restart_interval):
+      return 0
+    if (frame == None) or (frame["height"] == 0) or (len(frame["components"]) == 0):
+      return None
+      
+    # Find the components in the scan
+    data = scan_segment.getData()
+    comp_ids = [ord(data[comp_offset]) for comp_offset in range(1, 1 + 2 * ord(data[0]), 2)]
+    for comp_id in comp_ids:
+      if (comp_id not in frame["components"]):
+        return None
+        
+    # Calculate the number of MCU's. For interleaved scans, an MCU covers
+    # 8 by 8 pixels times the maximum sampling factors, otherwise it is a single
+    # 8 by 8 block of the (subsampled) component.
+    h_max = max([sampling[0] for sampling in frame["components"].values()])
+    v_max = max([sampling[1] for sampling in frame["components"].values()])
+    if (len(comp_ids) > 1):
+      mcus_x = -(-frame["width"] // (8 * h_max))
+      mcus_y = -(-frame["height"] // (8 * v_max))
+    else:
+      h, v = frame["components"][comp_ids[0]]
+      mcus_x = -(-(-(-frame["width"] * h // h_max)) // 8)
+      mcus_y = -(-(-(-frame["height"] * v // v_max)) // 8)
+      
+    return -(-(mcus_x * mcus_y) // restart_interval) - 1
+    
+  def __scanEntropyData__(self, offset, errors):
+    """ Search the entropy coded data starting at offset for the first marker
+        which is not a restart marker. Return its offset (or None if the data
+        ends first) and the number of restart markers found. Restart markers
+        out of sequence are reported in the errors list. """
+        
+    block    = datablock.DataBlock(offset = offset, **self.__getDataSource__())
+    restarts = 0
+    scanned  = 0
+    while (True):
+      chunk = block.read(datablock.COPY_CHUNK_SIZE, scanned)
+      if (len(chunk) < 2):
+        return [None, restarts]
+        
+      for match in MARKER_PATTERN.finditer(chunk):
+        number = ord(match.group()[1])
+        if (number >= SEG_NUMS["RST0"]) and (number <= SEG_NUMS["RST7"]):
+          if (number - SEG_NUMS["RST0"] != restarts % 8):
+            errors.append("Restart marker out of sequence at offset %d" % (offset + scanned + match.start()))
+          restarts += 1
+        else:
+          return [offset + scanned + match.start(), restarts]
+          
+      # Let the next chunk overlap with one byte, so we find markers which
+      # are split over two chunks
+      scanned += len(chunk) - 1
     
   def loadExif(self):
     """ Load the Exif data from the file. """
     
     # Try to find the Exif data. It should be in one off the APP1 segments,
     # marked by "Exif\x00\x00"
-    for seg in self.segments[SEG_NUMS["APP1"]]:
-      if (seg.read(6, 0) == "Exif\x00\x00"):
-        self.exif_segment = seg
-        tiff_block = tiff.Tiff(self.fp, seg.getDataOffset() + 6) # 6 bytes Exif marker
-        tiff_block.loadExif()
-        tiff_block.loadIPTC()
-        self.exif = tiff_block.exif
-        if (tiff_block.iptc.hasTags()): # FIXME: Dunno if this is actually possible
-          self.iptc = tiff_block.iptc
-        break
+    tiff_block = self.__getTiffBlock__()
+    if (tiff_block):
+      tiff_block.loadExif()
+      self.exif = tiff_block.exif
 
+  def __getTiffBlock__(self):
+    """ Return a Tiff object for the Exif data in the APP1 segment, or None if
+        there is no Exif data. """
+        
+    seg = self.__findExifSegment__()
+    if not (seg):
+      return None
+      
+    tiff_offset = seg.getDataOffset() + 6 # 6 bytes Exif marker
+    if (self.data != None):
+      return tiff.Tiff(self.data, tiff_offset)
+    return tiff.Tiff(self.fp, tiff_offset)
+    
+  def __findExifSegment__(self):
+    """ Find the APP1 segment holding the Exif data, store it in exif_segment
+        and return it, or return None if there is none. The Exif data itself
+        is not decoded. """
+        
+    if (self.exif_segment == None):
+      for seg in self.__iterSegments__(SEG_NUMS["APP1"]):
+        if (seg.read(6, 0) == "Exif\x00\x00"):
+          self.exif_segment = seg
+          break
+          
+    return self.exif_segment
+    
   def loadIPTC(self):
     """ Load the IPTC data from the file. """
     
-    # If the IPTC info wasn't encoded in the Tiff IFD, we can look for it in
-    # APP13 (Photoshop data) (0xED)
+    # The IPTC info is normally stored in APP13 (Photoshop data) (0xED)
     if (self.iptc == None):
-      for seg in self.segments[SEG_NUMS["APP13"]]:
-        if (seg.read(14, 0) == "Photoshop 3.0\x00"):
-          ps = photoshop.Photoshop(fp = self.fp, offset = self.fp.tell(), length = seg.getDataLength())
-          if (1028 in ps.tags): # IPTC info is tag 1028
-            self.iptc_segment = seg
-            self.ps_info      = ps
-            self.iptc = iptcnaa.IPTC(self.fp, ps.tags[1028].getDataOffset(), ps.tags[1028].getDataLength())
+      iptc_block = self.__findIPTCSegments__()
+      if (iptc_block):
+        self.iptc = iptcnaa.IPTC(fp = iptc_block.fp, offset = iptc_block.getDataOffset(), length = iptc_block.getDataLength())
 
+    # Otherwise, it may be encoded in the Tiff IFD of the Exif data. This is only
+    # checked here, so loading the Exif data doesn't require parsing the Tiff
+    # IFD.
+    if (self.iptc == None):
+      tiff_block = self.__getTiffBlock__()
+      if (tiff_block):
+        tiff_block.exif = self.__getExif__()
+        tiff_block.loadIPTC()
+        if (tiff_block.iptc.hasTags()): # FIXME: Dunno if this is actually possible
+          self.iptc = tiff_block.iptc
+          
     # If we didn't find IPTC info, create an empty object and the containing
     # structures
     if (self.iptc == None):
       self.iptc = iptcnaa.IPTC()
 
-  def writeFile(self, file_path):
+  def __findIPTCSegments__(self):
+    """ Find the APP13 segments holding the Photoshop data with the IPTC info,
+        and store them in iptc_segments and the parsed Photoshop structure in
+        ps_info. Returns the DataBlock holding the encoded IPTC data, or None
+        if there is none. The IPTC data itself is not decoded. """
+        
+    if (not self.ps_info):
+      for seg in self.__iterSegments__(SEG_NUMS["APP13"]):
+        if (seg.read(14, 0) == "Photoshop 3.0\x00"):
+          # The Photoshop data may continue in the next segments, so we parse
+          # it from the chained contents of all these segments.
+          segments = self.__getSegmentRun__(seg, "Photoshop 3.0\x00")
+          payload  = self.__getPayload__(segments, 14)
+          ps = photoshop.Photoshop(fp = payload, offset = 0, length = payload.getDataLength())
+          if (1028 in ps.tags): # IPTC info is tag 1028
+            self.iptc_segments = segments
+            self.ps_info       = ps
+            break
+            
+    if (self.ps_info):
+      return self.ps_info.tags[1028]
+    return None
+    
+  def writeFile(self, file_path = None, padding = 0, exif = None, iptc = None):
+    """ Write the file with the current metadata to the specified path or
+        writable file-like object, which doesn't need to be seekable. If the
+        path is None, the file is returned as string instead. The optional
+        padding parameter specifies the number of bytes to reserve at the end
+        of the Exif and IPTC segments, so later metadata changes may be written
+        in place with updateFile().
+        Writing doesn't change the object, so it may be called many times to
+        write variants of the same file. The optional exif and iptc arguments
+        specify an exif.Exif or iptcnaa.IPTC object to write instead of the
+        metadata of the file itself. Metadata which was never loaded and isn't
+        replaced is copied unchanged, without decoding it (unless padding is
+        requested). """
+        
+    # Make sure we know all segments and where the image data starts, and
+    # which segments hold the metadata
+    self.__walkSegments__()
+    exif_segment = self.__findExifSegment__()
+    self.__findIPTCSegments__()
+    
+    # Make a copy of the segment lists, in which we replace the metadata
+    # segments for this output only.
+    segments = {}
+    for seg_num in self.segments:
+      segments[seg_num] = list(self.segments[seg_num])
+      
+    # Put the Exif data into an appropriate APP1 segment
+    if (exif == None) and ((self.exif != None) or (padding > 0)):
+      exif = self.__getExif__()
+    if (exif != None):
+      if (exif.hasTags()):
+        exif_segments = [Segment(num = SEG_NUMS["APP1"], data = self.__pad__(self.__getExifData__(exif), padding))]
+      else:
+        exif_segments = []
+      if (exif_segment):
+        self.__replaceSegments__([exif_segment], exif_segments, segments)
+      else:
+        self.__replaceSegments__([], exif_segments, segments)
+    
+    # Prepare the IPTC segments for writing, splitting the Photoshop data over
+    # multiple segments if needed. If we don't have any tags, the IPTC segments
+    # and Photoshop info are left out.
+    if (iptc == None) and ((self.iptc != None) or (padding > 0)):
+      iptc = self.__getIPTC__()
+    if (iptc != None):
+      if (iptc.hasTags()):
+        iptc_segments = splitPayload(SEG_NUMS["APP13"], self.__getIPTCData__(iptc), "Photoshop 3.0\x00")
+        iptc_segments[-1].setData(self.__pad__(iptc_segments[-1].getData(), padding), 0)
+      else:
+        iptc_segments = []
+      self.__replaceSegments__(self.iptc_segments, iptc_segments, segments)
+    
+    # Collect all segments from the original file or rewrite them, so
+    # everything up to the image data is written at once.
+    blobs = ["\xff\xd8"]
+    for seg_type in SEGMENTS:
+      for segment in segments[SEG_NUMS[seg_type]]:
+        blobs.append(segment.getBlob())
+        
     # Open the new file for writing
-    out_fp = convenience.PersistentFileHandle(file_path, "wb")
-    out_fp.write("\xff\xd8")
+    out_fp = self.__openOutput__(file_path)
+    out_fp.write("".join(blobs))
     
-    # Prepare the Exif segment for writing
+    # Write the image data
+    if (self.image_data_offset): # We only do the check here and not in the parsing, so we can still extract metadata from a broken image file
+      image_data = datablock.DataBlock(offset = self.image_data_offset, **self.__getDataSource__())
+      image_data.writeTo(out_fp)
+      self.__passStream__(out_fp)
+    else:
+      raise JpegError, "Due to an error in the parsing of the file, it can not be written."
+    
+    return self.__closeOutput__(out_fp, file_path)
+    
+  def updateFile(self):
+    """ Write the changed Exif and IPTC data back into the original file, by
+        overwriting the existing APP1 and APP13 segments. This only works when
+        the newly encoded data fits in the space of these segments (including
+        any padding), in which case True is returned. Otherwise, nothing is
+        written and False is returned, and the file needs to be written with
+        writeFile(). """
+
+    # We can only update files on disk
+    if not (isinstance(self.fp, convenience.PersistentFileHandle)):
+      return False
+      
+    # Encode the metadata that was loaded, and check whether it fits. Only when
+    # everything fits we start writing. Metadata which was never loaded hasn't
+    # changed, so it doesn't need to be written.
+    updates = []
+    if (self.exif != None):
+      if (self.exif.hasTags()):
+        updates.append([self.exif_segment, self.__getExifData__()])
+      elif (self.exif_segment):
+        return False
+    if (self.iptc != None):
+      if (self.iptc.hasTags()):
+        # Photoshop data spread over multiple segments can't be updated
+        if (len(self.iptc_segments) != 1):
+          return False
+        updates.append([self.iptc_segments[0], "Photoshop 3.0\x00" + self.__getIPTCData__()])
+      elif (self.iptc_segments):
+        return False
+        
+    for segment, byte_str in updates:
+      # A segment from the file can never start at offset 0, since the file
+      # starts with the SOI marker. Segments at offset 0 were constructed in
+      # memory.
+      if (not segment) or (segment.getDataOffset() == 0):
+        return False
+      if (len(byte_str) > segment.getDataLength()):
+        return False
+        
+    # Overwrite the segment contents, and pad them to their original length
+    out_fp = convenience.PersistentFileHandle(self.fp.filename, "r+b")
+    for segment, byte_str in updates:
+      out_fp.seek(segment.getDataOffset())
+      out_fp.write(self.__pad__(byte_str, segment.getDataLength() - len(byte_str)))
+    out_fp.close()
+    
+    # Reopen our own file handle, so no stale buffered data is read
+    self.fp.close()
+    self.fp.open()
+    
+    # The loaded metadata refers to the old layout of the segments, so it needs
+    # to be reloaded on the next request.
+    self.exif          = None
+    self.iptc          = None
+    self.exif_segment  = None
+    self.iptc_segments = []
+    self.ps_info       = None
+    
+    return True
+
+  def __getExifData__(self, exif = None):
+    """ Return the encoded content of the Exif APP1 segment, for the specified
+        Exif object or the Exif data of the file. """
+    
+    if (exif == None):
+      exif = self.__getExif__()
+      
     # Write the Exif header
     byte_str = "Exif\x00\x00"
     
     # Construct the Tiff header
-    ifd_big_endian = self.__getExif__().big_endian
+    ifd_big_endian = exif.big_endian
     if (ifd_big_endian):
       byte_str += "\x4d\x4d"
     else:
@@ -295,63 +976,235 @@ class Jpeg(metainfofile.MetaInfoFile):
     byte_str += byteform.itob(8, 4, big_endian = ifd_big_endian)
     
     # Write the Exif data
-    byte_str += self.__getExif__().getBlob(8)
-    
-    # Put the Exif data into an appropriate APP1 segment. FIXME: This
-    # invalidates that segment for future data extraction.
-    exif = self.__getExif__()
-    if (exif.hasTags()):
-      if (not self.exif_segment):
-        self.exif_segment = Segment(num = SEG_NUMS["APP1"], data = byte_str)
-        self.segments[SEG_NUMS["APP1"]].append(self.exif_segment)
-      else:
-        self.exif_segment.setData(byte_str, 0)
+    byte_str += exif.getBlob(8)
+    
+    return byte_str
+    
+  def __getIPTCData__(self, iptc = None):
+    """ Return the encoded Photoshop data for the APP13 segments, which holds
+        the specified IPTC object or the IPTC data of the file. The Photoshop
+        info of the file itself is left untouched. """
+        
+    if (iptc == None):
+      iptc = self.__getIPTC__()
+    ps_info = self.ps_info
+    if (not ps_info):
+      ps_info = photoshop.Photoshop()
+      
+    return ps_info.getDataBlock({1028: iptc.getBlob()})
+    
+  def __replaceSegments__(self, old_segments, new_segments, segments = None):
+    """ Replace the old segments by the new ones, at the position of the first
+        old one. If there are no old segments, the new ones are appended. All
+        segments should be of the same type. The replacement is done in the
+        specified dict of segment lists, or in that of the file itself. """
+    
+    if (len(old_segments) == 0) and (len(new_segments) == 0):
+      return
+    if (segments == None):
+      segments = self.segments
+    seg_list = segments[(old_segments + new_segments)[0].getNumber()]
+    if (len(old_segments) > 0):
+      index = seg_list.index(old_segments[0])
+      for segment in old_segments:
+        seg_list.remove(segment)
     else:
-      if (self.exif_segment):
-        del self.segments[SEG_NUMS["APP1"]][self.segments[SEG_NUMS[APP1]].index(self.exif_segment)]
-        self.exif_segment = None
-    
-    # Prepare the IPTC segment for writing. FIXME: This
-    # invalidates that segment for future data extraction.
-    iptc = self.__getIPTC__()
-    if (iptc.hasTags()):
-      if (not self.iptc_segment):
-        self.iptc_segment = Segment(num = SEG_NUMS["APP13"])
-        self.segments[SEG_NUMS["APP13"]].append(self.iptc_segment)
-      if (not self.ps_info):
-        self.ps_info = photoshop.Photoshop()
-      self.ps_info.setTag(1028, self.__getIPTC__().getBlob())
-      self.iptc_segment.setData("Photoshop 3.0\x00" + self.ps_info.getDataBlock(), 0)
-    # If we don't have any tags, remove the IPTC segment and Photoshop info
+      index = len(seg_list)
+    seg_list[index:index] = new_segments
+    
+  def __pad__(self, byte_str, padding):
+    """ Append padding zero bytes to the segment content, without exceeding the
+        maximum segment length. """
+    
+    padding = min(padding, MAX_SEGMENT_LENGTH - len(byte_str))
+    if (padding > 0):
+      byte_str += "\x00" * padding
+      
+    return byte_str
+    
+  def stripFile(self, file_path = None, drop = STRIP_SEGMENTS, keep = None):
+    """ Write the file without the metadata segments to the specified path or
+        writable file-like object, or return it as string if the path is None.
+        drop is a list with the names
+        of the segment types to leave out, which defaults to the Exif, XMP,
+        IPTC and comment segments. Alternatively, keep may specify a list of
+        segment names to write, in which case all other segments are left out.
+        Note that the image can't be decoded without its tables segments.
+        The kept segments and the image data are copied directly from the
+        original file, without decoding any metadata. """
+    
+    # Find out which segment numbers we should write
+    if (keep != None):
+      keep_nums = [SEG_NUMS[seg_type] for seg_type in keep]
     else:
-      if (self.iptc_segment):
-        del self.segments[SEG_NUMS["APP13"]][self.segments[SEG_NUMS["APP13"]].index(self.iptc_segment)]
-        self.iptc_segment = None
-      if (self.ps_info):
-        self.ps_info = None
-    
-    # Iterate over all segments and copy them from the original file or rewrite
-    # them.
-    for seg_type in SEGMENTS:
-      seg_num = SEG_NUMS[seg_type]
-      for segment in self.segments[seg_num]:
-        # Write the segment
-        out_fp.write(segment.getBlob())
-        
-    # Write the image data
-    if (self.image_data_offset): # We only do the check here and not in the parsing, so we can still extract metadata from a broken image file
-      self.fp.seek(self.image_data_offset)
-      out_fp.write(self.fp.read())
+      drop_nums = [SEG_NUMS[seg_type] for seg_type in drop]
+      keep_nums = [SEG_NUMS[seg_type] for seg_type in SEGMENTS if (SEG_NUMS[seg_type] not in drop_nums)]
+
+    # Make sure we know all segments and where the image data starts
+    self.__walkSegments__()
+    if (self.image_data_offset == None):
+      raise JpegError, "Due to an error in the parsing of the file, it can not be written."
+      
+    # Collect the byte ranges to copy, merging adjacent ones so they can be
+    # copied at once. The image data runs up to the end of the file.
+    ranges = []
+    for segment in self.file_segments:
+      if (segment.getNumber() in keep_nums):
+        start = segment.getDataOffset() - 4 # Include the header
+        end   = segment.getDataOffset() + segment.getDataLength()
+        if (len(ranges) > 0) and (ranges[-1][1] == start):
+          ranges[-1][1] = end
+        else:
+          ranges.append([start, end])
+    if (len(ranges) > 0) and (ranges[-1][1] == self.image_data_offset):
+      ranges[-1][1] = None
     else:
-      raise "Due to an error in the parsing of the file, it can not be written."
+      ranges.append([self.image_data_offset, None])
+      
+    # Write the header, and copy the ranges
+    out_fp = self.__openOutput__(file_path)
+    out_fp.write("\xff\xd8")
+    source = self.__getDataSource__()
+    for start, end in ranges:
+      if (end == None):
+        block = datablock.DataBlock(offset = start, **source)
+      else:
+        block = datablock.DataBlock(offset = start, length = end - start, **source)
+      block.writeTo(out_fp)
+    self.__passStream__(out_fp)
     
-    out_fp.close()
+    return self.__closeOutput__(out_fp, file_path)
+    
+  def getICCProfile(self):
+    """ Return the ICC profile as a DataBlock, or None if the file has no
+        profile, or if the profile is incomplete. A profile may be spread over
+        multiple APP2 segments, which are presented as a single block without
+        copying them together. """
+    
+    # Each ICC segment starts with "ICC_PROFILE\x00", followed by the sequence
+    # number of the segment (starting with 1) and the total number of segments.
+    chunks     = {}
+    num_chunks = None
+    for seg in self.__iterSegments__(SEG_NUMS["APP2"]):
+      header = seg.read(14, 0)
+      if (header) and (len(header) == 14) and (header[:12] == "ICC_PROFILE\x00"):
+        chunk_num = ord(header[12])
+        # A repeated sequence number means we can't tell which chunk is right
+        if (chunk_num in chunks):
+          return None
+        chunks[chunk_num] = seg
+        num_chunks = ord(header[13])
+        if (len(chunks) == num_chunks):
+          break
+          
+    if (num_chunks == None):
+      return None
+      
+    # Don't return a partial profile if a chunk is missing
+    chunk_nums = chunks.keys()
+    chunk_nums.sort()
+    if (chunk_nums != range(1, num_chunks + 1)):
+      return None
+      
+    return self.__getPayload__([chunks[chunk_num] for chunk_num in chunk_nums], 14)
+    
+  def setICCProfile(self, profile):
+    """ Set the ICC profile to the binary string, splitting it over as many
+        APP2 segments as needed. If profile is None, the profile is removed. """
+    
+    # Find all the old ICC segments
+    self.__walkSegments__()
+    old_segments = []
+    for seg in self.segments[SEG_NUMS["APP2"]]:
+      if (seg.read(12, 0) == "ICC_PROFILE\x00"):
+        old_segments.append(seg)
+        
+    # Create the new segments, with the sequence number and the total number
+    # of segments after the marker
+    new_segments = []
+    if (profile):
+      chunk_size = MAX_SEGMENT_LENGTH - 14
+      num_chunks = (len(profile) + chunk_size - 1) / chunk_size
+      for chunk_num in range(num_chunks):
+        chunk = profile[chunk_num * chunk_size:(chunk_num + 1) * chunk_size]
+        header = "ICC_PROFILE\x00" + chr(chunk_num + 1) + chr(num_chunks)
+        new_segments.append(Segment(num = SEG_NUMS["APP2"], data = header + chunk))
+        
+    self.__replaceSegments__(old_segments, new_segments)
+    
+  def getExtendedXMP(self, guid = None):
+    """ Return the extended XMP data with the specified GUID (as found in the
+        xmpNote:HasExtendedXMP property of the main XMP packet) as a DataBlock,
+        or None if it isn't present. If guid is None, the first extended XMP
+        data found is returned. The data is spread over multiple APP1 segments,
+        which are presented as a single block without copying them together.
+    """
+    
+    # Each extended XMP segment starts with the marker, the GUID, the total
+    # length of the data, and the offset of the part in this segment.
+    marker  = "http://ns.adobe.com/xmp/extension/\x00"
+    chunks  = {}
+    length  = None
+    found   = 0
+    for seg in self.__iterSegments__(SEG_NUMS["APP1"]):
+      if (seg.read(len(marker), 0) == marker):
+        seg_guid = seg.read(32)
+        if (guid == None):
+          guid = seg_guid
+        if (seg_guid == guid):
+          length = byteform.btousi(seg.read(4), big_endian = self.big_endian)
+          offset = byteform.btousi(seg.read(4), big_endian = self.big_endian)
+          chunks[offset] = seg
+          found += seg.getDataLength() - len(marker) - 40
+          if (found >= length):
+            break
+            
+    if (length == None):
+      return None
+      
+    offsets = chunks.keys()
+    offsets.sort()
+    return self.__getPayload__([chunks[offset] for offset in offsets], len(marker) + 40)
+    
+  def getMPFImages(self):
+    """ Return a list of DataBlocks with the encoded images from the
+        Multi-Picture Format index, like large previews appended to the file,
+        or None if the file has no such index. The first block is the primary
+        image. The blocks refer directly to the file, so no image data is read
+        until it's requested from them. This is not possible for input streams,
+        since the images follow the primary image. """
+        
+    if (self.stream):
+      raise JpegError, "The images of an input stream can't be accessed."
+    mp_index = self.__getMPF__()
+    if (mp_index == None):
+      return None
+      
+    images = []
+    for image_num in range(mp_index.getNumImages()):
+      images.append(mp_index.getImage(image_num, self.offset))
+    
+    return images
+    
+  def __getMPF__(self):
+    """ Return the Multi-Picture index, or None if the file doesn't have one.
+        It is loaded from the first APP2 segment marked with "MPF\x00" when
+        requested for the first time. """
+        
+    if (self.mpf == None):
+      for seg in self.__iterSegments__(SEG_NUMS["APP2"]):
+        if (seg.read(4, 0) == "MPF\x00"):
+          self.mpf = mpf.MPF(offset = seg.getDataOffset() + 4, length = seg.getDataLength() - 4, **self.__getDataSource__())
+          break
+          
+    return self.mpf
     
   def getComments(self):
     """ Return a list with the file comments, or None if no comment was found.
     """
 
     # Loop over the comment segments 
+    self.__walkSegments__()
     comments = []
     for com_seg in self.segments[SEG_NUMS["COM"]]:
       comments.append(com_seg.getData())
@@ -366,8 +1219,107 @@ class Jpeg(metainfofile.MetaInfoFile):
     """ Set the JPEG comment. If append is True, the comment will be recorded as
         an additional COM segment. """
         
+    self.__walkSegments__()
     segment = Segment(num = SEG_NUMS["COM"], data = comment)
     if (append):
       self.segments[SEG_NUMS["COM"]].append(segment)
     else:
       self.segments[SEG_NUMS["COM"]] = [segment]
+
+def stripTree(in_dir, out_dir, drop = STRIP_SEGMENTS, keep = None):
+  """ Strip the metadata from all Jpeg files in the directory tree in_dir, and
+      write them to the same relative paths in out_dir. The drop and keep
+      parameters are passed to Jpeg.stripFile(). Files are processed one by
+      one, and copied without loading them as a whole. If out_dir is inside
+      in_dir, it is not walked. Files which can't be parsed or written are
+      skipped without leaving any output, and returned as a list of [path,
+      error message] pairs. """
+      
+  failed   = []
+  out_real = os.path.realpath(out_dir)
+  for dir_path, dir_names, file_names in os.walk(in_dir):
+    # Don't descend into the output directory
+    dir_names[:] = [dir_name for dir_name in dir_names if (os.path.realpath(os.path.join(dir_path, dir_name)) != out_real)]
+    
+    # Create the output directory
+    out_path = os.path.join(out_dir, os.path.relpath(dir_path, in_dir))
+    if not (os.path.isdir(out_path)):
+      os.makedirs(out_path)
+      
+    for file_name in file_names:
+      if (os.path.splitext(file_name)[1].lower() in JPEG_EXTENSIONS):
+        in_file  = os.path.join(dir_path, file_name)
+        out_file = os.path.join(out_path, file_name)
+        
+        # Open the files ourselves, so they are closed even if the file can't
+        # be parsed or written
+        in_fp = open(in_file, "rb")
+        try:
+          try:
+            # Parse the file up to the image data before creating the output,
+            # so nothing is written for files which can't be parsed
+            jpeg = Jpeg(in_fp)
+            jpeg.__walkSegments__()
+            if (jpeg.image_data_offset == None):
+              raise JpegError, "No image data found"
+            out_fp = open(out_file, "wb")
+            try:
+              jpeg.stripFile(out_fp, drop, keep)
+            except:
+              # Don't leave a partial output file
+              out_fp.close()
+              os.remove(out_file)
+              raise
+            out_fp.close()
+          except Exception, error:
+            failed.append([in_file, str(error)])
+        finally:
+          in_fp.close()
+          
+  return failed
+
+def ingestFile(source, file_path, exif = None, iptc = None, checksum = None):
+  """ Copy the Jpeg file from source, which may be a path, a file object or a
+      stream, to file_path, which may be a path or a writable file object. The
+      Exif and IPTC data are replaced by the specified exif.Exif and
+      iptcnaa.IPTC objects while copying; if one of them is None, the original
+      segments are copied unchanged. The source is read and the output written
+      only once, and the metadata of the source is never decoded.
+      If checksum is the name of a hashlib algorithm, like "md5" or "sha1", a
+      digest of the written file is calculated during the copy and returned as
+      a hex string. Otherwise None is returned. """
+      
+  jpeg = Jpeg(source)
+  
+  # Open the output ourselves if we need to wrap it for the checksum
+  out_fp = file_path
+  if (checksum != None) and (type(file_path) in [types.StringType, types.UnicodeType]):
+    out_fp = convenience.PersistentFileHandle(file_path, "wb")
+  if (checksum != None):
+    writer = datablock.DigestWriter(out_fp, checksum)
+  else:
+    writer = out_fp
+    
+  jpeg.writeFile(writer, exif = exif, iptc = iptc)
+  
+  # Close the files we opened
+  if (out_fp is not file_path):
+    out_fp.close()
+  if (isinstance(jpeg.fp, convenience.PersistentFileHandle)) and (jpeg.fp is not source):
+    jpeg.fp.close()
+    
+  if (checksum != None):
+    return writer.hexdigest()
+  return None
+  
+def splitPayload(seg_num, payload, header):
+  """ Split the payload over as many segments with the specified number as
+      needed, each starting with the header string. Return the list of
+      segments. """
+  
+  chunk_size = MAX_SEGMENT_LENGTH - len(header)
+  segments   = []
+  for start in range(0, max(len(payload), 1), chunk_size):
+    segments.append(Segment(num = seg_num, data = header + payload[start:start + chunk_size]))
+    
+  return segments
@@ -33,7 +33,7 @@ class FujifilmIFD(ifd.IFD):
   tags.addList("data_type", [])
   tags.addList("count", [])
 
-  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = False):
+  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = False, budget = None):
     # Fujifilm always uses little endian
     block = datablock.DataBlock(fp = file_pointer, offset = ifd_offset + header_offset, data = data)
     header = block.read(8)
@@ -44,7 +44,7 @@ class FujifilmIFD(ifd.IFD):
     else:
       raise "No valid Fujifilm Makernote!"
       
-    ifd.IFD.__init__(self, file_pointer, mn_offset, ifd_offset + header_offset, data, big_endian = False)
+    ifd.IFD.__init__(self, file_pointer, mn_offset, ifd_offset + header_offset, data, big_endian = False, budget = budget)
     
   def getBlob(self, offset, next_ifd = 0):
     ret_str = "FUJIFILM"
@@ -60,7 +60,7 @@ class IFDWithHeader(ifd.IFD):
                        length of the header string, if that contains extra info.
   """
   
-  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = True):
+  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = True, budget = None):
     # Create a temporary Datablock to parse the data
     block = datablock.DataBlock(fp = file_pointer, offset = ifd_offset, data = data)
     
@@ -73,7 +73,7 @@ class IFDWithHeader(ifd.IFD):
     self.extra_bytes = block.read(self.header_length - len(self.header_string))
     
     # Initialize the IFD
-    ifd.IFD.__init__(self, file_pointer, ifd_offset + self.header_length, header_offset, data, big_endian)
+    ifd.IFD.__init__(self, file_pointer, ifd_offset + self.header_length, header_offset, data, big_endian, budget)
 
   def getBlob(self, offset, next_ifd = 0):
     """ Simple modified writeBlob, which writes the header string and the saved
@@ -90,9 +90,9 @@ class MinoltaIFD(ifd.IFD):
   tags.addList("data_type", [])
   tags.addList("count", [])
 
-  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = True):
+  def __init__(self, file_pointer = None, ifd_offset = 0, header_offset = 0, data = None, big_endian = True, budget = None):
     # Minolta always uses big endian
-    ifd.IFD.__init__(self, file_pointer, ifd_offset, header_offset, data, big_endian = True)
+    ifd.IFD.__init__(self, file_pointer, ifd_offset, header_offset, data, big_endian = True, budget = budget)
     
 class OlympusIFD(IFDWithHeader):
   header_str    = "OLYMP\x00"
@@ -17,7 +17,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 # 
 
-import byteform, datablock, qdb, types, shutil
+import byteform, datablock, qdb, types, shutil, cStringIO, convenience
    
 class MetaInfoBlock:
   """ The base class for a particuler kind of metainformation structure, like
@@ -34,6 +34,9 @@ class MetaInfoBlock:
                             This class provides a basic method for that, but
                             derived classes may override it to only load a
                             record when requested.
+      Derived classes which load records on request may also override
+      getRecordClass(rec_num), so tag names can be resolved from the tag tables
+      of the record classes without loading the records.
       Furthermore, it should have a dict called DATA_TYPES, where the keys
       are the number of each data type, and the values a class to manipulate
       that particular kind of data.
@@ -44,18 +47,7 @@ class MetaInfoBlock:
     """
     
     # Get the official record and tag numbers
-    tag_num    = None
-    record_num = None
-    try:
-      record_num, tag_num = self.__getRecordAndTagNum__(tag, record)
-    except KeyError:
-      # We're dealing with an unknown tag, but it may have been loaded from disk
-      if (record):
-        if (type(tag) == types.IntType):
-          tag_num = tag
-          record_num = self.__getRecordNum__(record)
-      if (tag_num == None) or (record_num == None):
-        raise TypeError, "Unknown tag %s, please specify tag number and record number" % str(tag)
+    record_num, tag_num = self.__resolveTag__(tag, record)
         
     # Get the data
     if (record_num):
@@ -74,6 +66,67 @@ class MetaInfoBlock:
       
     return None
     
+  def getTags(self, tags, record = None):
+    """ Return a list with the data of the specified tags, like getTag. Each
+        tag may be a name or number, or a [tag, record] pair if it's in another
+        record than the optional record parameter. All tags are resolved
+        first, so the tags of each record can be retrieved at once. """
+        
+    # Resolve all tags and group the tag numbers per record
+    resolved = []
+    tag_nums = {}
+    for tag in tags:
+      tag_record = record
+      if (type(tag) in [types.ListType, types.TupleType]):
+        tag, tag_record = tag
+      record_num, tag_num = self.__resolveTag__(tag, tag_record)
+      resolved.append([record_num, tag_num])
+      if (record_num):
+        tag_nums.setdefault(record_num, []).append(tag_num)
+        
+    # Retrieve the data per record
+    payloads = {}
+    for record_num in tag_nums:
+      record_obj = self.getRecord(record_num)
+      if (record_obj):
+        data = record_obj.getTags(tag_nums[record_num])
+      else:
+        data = [False] * len(tag_nums[record_num])
+      for tag_num, payload in zip(tag_nums[record_num], data):
+        payloads[(record_num, tag_num)] = payload
+        
+    # Return the data in the requested order
+    ret = []
+    for record_num, tag_num in resolved:
+      if (record_num):
+        ret.append(payloads[(record_num, tag_num)])
+      else:
+        ret.append(None)
+    return ret
+    
+  @classmethod
+  def prepare(cls, tag, record = None, data_type = None):
+    """ Return a TagHandle for the tag with the specified name or number in the
+        optional record. The record and tag number are resolved only once, so
+        the handle can retrieve the tag from many files without looking it up
+        again. The optional data_type is passed on to the getTag method of the
+        record. If the record is omitted and the tag occurs in multiple
+        records, the first one is used, like the Tiff IFD for Exif tags which
+        may also be in IFD1. """
+        
+    block, record_num, tag_num = cls.__resolveForHandle__(tag, record)
+    return TagHandle(cls, record_num, tag_num, data_type)
+    
+  @classmethod
+  def __resolveForHandle__(cls, tag, record = None):
+    """ Resolve the tag for a TagHandle, in an empty structure, as only the tag
+        tables are needed. Returns the structure, the record number and the tag
+        number. """
+        
+    block = cls()
+    record_num, tag_num = block.__resolveTag__(tag, record, first = True)
+    return block, record_num, tag_num
+    
   def setTag(self, tag, payload = None, record = None, check = True, data_type = None, data_count = None, data = None):
     """ Set the specified tag in the specified record to the data, overriding
         all other occurences of that tag. If record num is omitted, the method
@@ -122,6 +175,18 @@ class MetaInfoBlock:
      
     return False
 
+  def getRecordClass(self, rec_num):
+    """ Return the class of the record with the specified number, which holds
+        its tag table, or None if there's no such record. This basic method
+        loads the record, but derived classes may override it to return the
+        class without loading. They may also return None if the class can only
+        be known by loading the record. """
+        
+    record = self.getRecord(rec_num)
+    if (record):
+      return record.__class__
+    return None
+    
   def __getRecordNum__(self, record):
     """ Return the record number based on a record number or name. """
     
@@ -141,11 +206,32 @@ class MetaInfoBlock:
     else:
       raise TypeError, "I can't make sense of an record of type %s!" % type(record)
 
-  def __getRecordAndTagNum__(self, tag, record = None):
+  def __resolveTag__(self, tag, record = None, first = False):
+    """ Return the record number and tag number for the supplied tag, like
+        __getRecordAndTagNum__, but also accept unknown tags specified by
+        number when the record is given. """
+        
+    tag_num    = None
+    record_num = None
+    try:
+      record_num, tag_num = self.__getRecordAndTagNum__(tag, record, first)
+    except KeyError:
+      # We're dealing with an unknown tag, but it may have been loaded from disk
+      if (record):
+        if (type(tag) == types.IntType):
+          tag_num = tag
+          record_num = self.__getRecordNum__(record)
+      if (tag_num == None) or (record_num == None):
+        raise TypeError, "Unknown tag %s, please specify tag number and record number" % str(tag)
+        
+    return record_num, tag_num
+    
+  def __getRecordAndTagNum__(self, tag, record = None, first = False):
     """ Return the record number and tag number for the supplied tag (name or
         number) in the specified record (name or number). If record is omitted,
         the method will search in all records and raise an error if
-        ambiguousnesses are found. """
+        ambiguousnesses are found, unless first is True, in which case the
+        first record with the tag is used. """
       
     # If the user didn't specify a record, we search through all records
     if (record == None):
@@ -154,20 +240,31 @@ class MetaInfoBlock:
     else:
       records = [self.__getRecordNum__(record)]
 
-    # Find the possible records
+    # Find the possible records in the tag tables of the record classes. Only
+    # if that fails, the records whose class can't be known up front are loaded
     found_records = []
+    unknown       = []
     for rec_num in records:
-      record = self.getRecord(rec_num)
-      if (record):
-        tag_num = self.getRecord(rec_num).getTagNum(tag)
+      rec_class = self.getRecordClass(rec_num)
+      if (rec_class):
+        tag_num = rec_class.getTagNum(tag)
         if (tag_num is not False):
           found_records.append([rec_num, tag_num])
+      else:
+        unknown.append(rec_num)
+    if (len(found_records) == 0):
+      for rec_num in unknown:
+        record = self.getRecord(rec_num)
+        if (record):
+          tag_num = record.getTagNum(tag)
+          if (tag_num is not False):
+            found_records.append([rec_num, tag_num])
 
     # Warn if the tag occurs in multiple records
     if (len(found_records) == 0):
       raise KeyError, "Tag %s is unknown!" % str(tag)
-    elif (len(found_records) > 1):
-      raise "Tag %s occurs in multiple records!" % str(tag)
+    elif (len(found_records) > 1) and not (first):
+      raise TypeError, "Tag %s occurs in multiple records, please specify the record!" % str(tag)
       
     return found_records[0]
 
@@ -188,21 +285,39 @@ class MetaInfoRecord(datablock.DataBlock):
       - setTag(tag_num, payload): set the payload of the tag with the specified
                                   number.
       - removeTag(tag_num): remove the tag with the specified number.
+      They may override getTags(tag_nums) to retrieve several tags at once.
+      Decoded payloads may be cached in a dict called payloads, in which case
+      setTag and removeTag should invalidate the entry for the tag.
   """
   
-  def getTagNum(self, tag):
+  def __copyPayload__(self, payload):
+    """ Return a copy of a decoded payload, so the payloads cached by derived
+        classes can't be changed by the caller. """
+        
+    if (type(payload) == types.ListType):
+      return [self.__copyPayload__(value) for value in payload]
+    return payload
+    
+  def getTags(self, tag_nums):
+    """ Return a list with the payloads of the specified tag numbers. """
+    
+    return [self.getTag(tag_num) for tag_num in tag_nums]
+    
+  @classmethod
+  def getTagNum(cls, tag):
     """ Return a tag number when fed a tag number or name, or False if it
-        doesn't exist within the current record. """
+        doesn't exist within the current record. Since this only uses the tag
+        table, it may also be called on the class. """
     
     tag_num = False
     
     # Try numeric input
     if (type(tag) == types.IntType):
-      if (self.tags.query("num", tag) is not False):
+      if (cls.tags.query("num", tag) is not False):
         tag_num = tag
     # Try text input
     elif (type(tag) == types.StringType):
-      tag_num = self.tags.query("name", tag, "num")
+      tag_num = cls.tags.query("name", tag, "num")
     else:
       raise TypeError, "Incorrect input type for finding tag numbers."
       
@@ -221,8 +336,40 @@ class MetaInfoRecord(datablock.DataBlock):
     return (len(self.fields) > 0)
 
 # Only import these here, as the need to have MetaInfoRecord loaded first
-import exif, iptc
+import exif, iptc, iptcnaa
 
+class TagHandle:
+  """ A tag in a metainformation structure, with its record number, tag number
+      and optionally data type resolved, as returned by MetaInfoBlock.prepare.
+      It retrieves the tag directly from the record, so it's a lot faster than
+      retrieving the tag by name when the same tags are read from many files.
+  """
+  
+  def __init__(self, block_class, record_num, tag_num, data_type = None):
+    self.block_class = block_class
+    self.record_num  = record_num
+    self.tag_num     = tag_num
+    self.data_type   = data_type
+    
+  def get(self, meta_info):
+    """ Return the payload of the tag in the MetaInfoFile or metainformation
+        structure, or False if it doesn't exist, like getExifTag or
+        getIPTCTag. """
+        
+    # Find the structure with the tag
+    if (isinstance(meta_info, MetaInfoFile)):
+      block = meta_info.__getBlock__(self.block_class)
+    else:
+      block = meta_info
+      
+    # Get the tag straight from the record
+    record = block.getRecord(self.record_num)
+    if not (record):
+      return False
+    if (self.data_type):
+      return record.getTag(self.tag_num, self.data_type)
+    return record.getTag(self.tag_num)
+    
 class MetaInfoFile:
   """ The base class for files containing meta information. """
   
@@ -231,6 +378,88 @@ class MetaInfoFile:
     self.exif = None
     self.iptc = None
     
+    # When the file is memory mapped, data holds a buffer to the mapping and all
+    # parsing is done on that instead of on the file pointer
+    self.data = None
+    
+    # Non-seekable inputs, like pipes and sockets, are kept in stream, and
+    # may only be read from front to back
+    self.stream = None
+    
+  def __openFile__(self, file_indicator, use_mmap = False, allow_stream = False):
+    """ Set up the file pointer or data buffer for the file indicator, which may
+        be a path, an open PersistentFileHandle or seekable file-like object, or
+        the file contents as buffer, bytearray or memoryview. Buffers are parsed
+        directly, without copying them. If use_mmap is True, a file on disk is
+        memory mapped and parsed from the mapping. If allow_stream is True, a
+        non-seekable file-like object is accepted as well, and stored in
+        self.stream; the subclass is responsible for reading it. """
+        
+    if (type(file_indicator) == types.StringType):
+      self.fp = convenience.PersistentFileHandle(file_indicator, "rb")
+    elif isinstance(file_indicator, convenience.PersistentFileHandle):
+      self.fp = file_indicator
+    elif (type(file_indicator) in [types.BufferType, bytearray, memoryview]):
+      self.fp   = None
+      self.data = file_indicator
+    elif (hasattr(file_indicator, "read")) and (self.__isSeekable__(file_indicator)):
+      self.fp = file_indicator
+    elif (hasattr(file_indicator, "read")) and (allow_stream):
+      self.fp     = None
+      self.stream = file_indicator
+    else:
+      raise TypeError, "No valid file parameter given -- file path, file object or buffer needed."
+      
+    # Map the file if requested and possible
+    if (use_mmap) and (isinstance(self.fp, convenience.PersistentFileHandle)):
+      self.data = datablock.mapFile(self.fp.filename)
+      
+  def __isSeekable__(self, file_obj):
+    """ Check whether the file-like object supports random access. Pipes and
+        sockets wrapped in file objects do have a seek method, but fail when
+        it's used. """
+        
+    if not (hasattr(file_obj, "seek")) or not (hasattr(file_obj, "tell")):
+      return False
+    try:
+      file_obj.tell()
+    except (IOError, OSError):
+      return False
+      
+    return True
+    
+  def __openOutput__(self, file_path):
+    """ Open the output for writing. If file_path is None, the output is
+        written to memory. If it is a writable file-like object, like an open
+        file, pipe or socket file, the output is written to it directly. The
+        output is written sequentially, so the object doesn't need to be
+        seekable. """
+        
+    if (file_path == None):
+      return cStringIO.StringIO()
+    elif (type(file_path) in [types.StringType, types.UnicodeType]):
+      return convenience.PersistentFileHandle(file_path, "wb")
+    elif (hasattr(file_path, "write")):
+      return file_path
+    else:
+      raise TypeError, "No valid output given -- file path or writable file object needed."
+      
+  def __closeOutput__(self, out_fp, file_path):
+    """ Close the output opened with __openOutput__. If the output was written
+        to memory, it is returned as string. File-like objects passed by the
+        caller are flushed, but left open. """
+        
+    data = None
+    if (file_path == None):
+      data = out_fp.getvalue()
+    if (out_fp is file_path):
+      if (hasattr(out_fp, "flush")):
+        out_fp.flush()
+    else:
+      out_fp.close()
+    
+    return data
+    
   def getExifTag(self, tag, record = None):
     """ Return the payload of the Exif tag with the specified name or number, or
         False if it doesn't exit. The optional record parameter specifies the
@@ -238,6 +467,20 @@ class MetaInfoFile:
     
     return self.__getExif__().getTag(tag, record)
       
+  def getExifTags(self, tags, record = None):
+    """ Return a list with the payloads of the specified Exif tags, like
+        getExifTag. Each tag may be a name or number, or a [tag, record] pair.
+        The data of all tags is read at once, in order of their position in the
+        file, which is much faster than retrieving them one by one. """
+        
+    return self.__getExif__().getTags(tags, record)
+    
+  def hasMetadata(self):
+    """ Return True if the file has any Exif or IPTC tags. This is a cheap
+        probe, which doesn't need to parse all the metadata from disk. """
+        
+    return (self.__getExif__().hasTags()) or (self.__getIPTC__().hasTags())
+      
   def setExifTag(self, tag, payload = None, record = None, check = True, data_type = None, count = None, data = None):
     """ Set the specified Exif tag name or number. Usually the payload parameter
         specifies the unencoded payload that needs to be set. Alternatively,
@@ -268,6 +511,13 @@ class MetaInfoFile:
     
     return self.__getIPTC__().getTag(tag, record, data_type)
     
+  def getIPTCTags(self, tags, record = None):
+    """ Return a list with the payloads of the specified IPTC tags, like
+        getIPTCTag. Each tag may be a name or number, or a [tag, record] pair.
+    """
+    
+    return self.__getIPTC__().getTags(tags, record)
+    
   def setIPTCTag(self, tag, payload = None, record = None, check = True, data_type = None, count = None, data = None):
     """ Set the specified IPTC tag name or number. Usually the payload parameter
         specifies the unencoded payload that needs to be set. Alternatively,
@@ -305,6 +555,16 @@ class MetaInfoFile:
     self.fp.filename = new_path
     self.fp.open()
       
+  def __getDataSource__(self):
+    """ Return a dict with either the file pointer or the mapped data of the
+        file, which can be passed as keyword arguments to DataBlock derived
+        classes. """
+        
+    if (self.data != None):
+      return {"data": self.data}
+    else:
+      return {"fp": self.fp}
+      
   def __getExif__(self):
     """ Return the file's Exif object. If it's not loaded yet, this method loads
         it from disk. By using this method rather the self.exif, it is possible
@@ -321,6 +581,17 @@ class MetaInfoFile:
 
     return self.exif
 
+  def __getBlock__(self, block_class):
+    """ Return the file's metainformation structure of the specified class,
+        loading it if needed. """
+        
+    if (issubclass(block_class, exif.Exif)):
+      return self.__getExif__()
+    elif (issubclass(block_class, iptcnaa.IPTC)):
+      return self.__getIPTC__()
+    else:
+      raise TypeError, "Unknown metainformation structure %s" % str(block_class)
+      
   def __getIPTC__(self):
     """ Return the file's IPTC/NAA object. If it's not loaded yet, this method 
         loads it from disk. By using this method rather the self.exif, it is
@@ -333,6 +604,6 @@ class MetaInfoFile:
 
     # If we couldn't load anything, create an empty IPTC object
     if (self.iptc == None):
-      self.iptc = IPTCNAA.IPTC()
+      self.iptc = iptcnaa.IPTC()
     
     return self.iptc
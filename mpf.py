@@ -0,0 +1,99 @@
+# Copyright 2007 Pieter Edelman (p _dot_ edelman _at_ gmx _dot_ net)
+#
+# This file is part of The Big Picture.
+# 
+# The Big Picture is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# The Big Picture is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with The Big Picture; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# 
+
+import datablock, byteform, ifd, qdb
+
+# The Multi-Picture Format (CIPA DC-007) stores additional images, like large
+# previews, after the end of the primary Jpeg image. They are indexed in an
+# APP2 segment, marked by "MPF\x00". This marker is followed by a Tiff-like
+# header and the MP Index IFD. All offsets are relative to the start of this
+# header.
+
+class MPIndexIFD(ifd.IFD):
+  tags = qdb.QDB()
+  # This info is taken from the CIPA DC-007 specification, section 5.2.3
+  tags.addList("name",      ["MPFVersion", "NumberOfImages", "MPEntry", "ImageUIDList", "TotalFrames"])
+  tags.addList("num",       [45056, 45057, 45058, 45059, 45060])
+  tags.addList("data_type", [7, 4, 7, 7, 4])
+  tags.addList("count",     [4, 1, False, False, 1])
+
+class MPF(datablock.DataBlock):
+  """ Read the Multi-Picture Format index. """
+  
+  def __init__(self, fp = None, data = None, offset = None, length = None):
+    """ Initialize with an open file object or a data buffer, and the offset to
+        the MP header (just after the "MPF\x00" marker). The index is parsed
+        on creation, the images themselves are not read. """
+    
+    # Call the DataBlock constructor
+    datablock.DataBlock.__init__(self, fp = fp, data = data, offset = offset, length = length)
+    
+    # Each entry is a list of the image attribute, the image size and the
+    # image offset relative to the MP header. The offset of the first image
+    # (the primary image) is always 0.
+    self.entries = []
+    self.parse()
+    
+  def parse(self):
+    """ Parse the MP header, the MP Index IFD and its list of entries. """
+    
+    # The header specifies the byte order and the offset to the index IFD
+    data = self.read(2, 0)
+    if (data == "MM"):
+      self.big_endian = True
+    elif (data == "II"):
+      self.big_endian = False
+    else:
+      raise IOError, "No valid MPF header!"
+    self.read(2) # 42
+    index_offset = byteform.btousi(self.read(4), big_endian = self.big_endian)
+    
+    # Load the index IFD
+    self.index = MPIndexIFD(self.fp, index_offset, self.getDataOffset(), self.data, big_endian = self.big_endian)
+    
+    # Each MP entry takes 16 bytes: four for the image attribute, four for the
+    # size, four for the offset and two times two for the dependent images.
+    entries = self.index.getTag(45058)
+    if (entries):
+      for entry_offset in range(0, len(entries) - 15, 16):
+        entry = entries[entry_offset:entry_offset + 16]
+        self.entries.append([
+          byteform.btousi(entry[0:4], big_endian = self.big_endian),
+          byteform.btousi(entry[4:8], big_endian = self.big_endian),
+          byteform.btousi(entry[8:12], big_endian = self.big_endian)
+        ])
+        
+  def getNumImages(self):
+    """ Return the number of images in the index. """
+    
+    return len(self.entries)
+
+  def getImage(self, image_num, primary_offset = 0):
+    """ Return a DataBlock referring to the encoded image with the specified
+        index number in the file. primary_offset is the offset of the primary
+        image in the file, which is needed for the first entry. No image data
+        is read. """
+        
+    attribute, size, offset = self.entries[image_num]
+    if (offset == 0):
+      offset = primary_offset
+    else:
+      offset += self.getDataOffset()
+      
+    return datablock.DataBlock(self.fp, offset, size, self.data)
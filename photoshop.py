@@ -64,7 +64,7 @@ class Photoshop(datablock.DataBlock):
         data_len = byteform.btousi(self.read(4), big_endian = self.big_endian)
          
         # Store the byte position and data length in the tags dict
-        self.tags[tag_num] = datablock.DataBlock(self.fp, self.byte_pos, data_len)
+        self.tags[tag_num] = datablock.DataBlock(self.fp, self.byte_pos, data_len, self.data)
         
         # Skip to the next structure
         self.read(data_len)
@@ -74,15 +74,24 @@ class Photoshop(datablock.DataBlock):
     
     self.tags[tag_num] = datablock.DataBlock(data = data)
     
-  def getDataBlock(self):
-    """ Return the Photoshop structure as a binary data block. """
+  def getDataBlock(self, overrides = None):
+    """ Return the Photoshop structure as a binary data block. The optional
+        overrides dict couples tag numbers to data which is written instead of
+        (or in addition to) the data of the structure itself. """
 
     # Store the buffer as string    
     out_str = ""
     
+    # Collect the tags to write
+    tags = self.tags
+    if (overrides):
+      tags = dict(self.tags)
+      for tag_num in overrides:
+        tags[tag_num] = datablock.DataBlock(data = overrides[tag_num])
+        
     # Iterate over all tags
-    for tag_num in self.tags:
-      tag = self.tags[tag_num]
+    for tag_num in tags:
+      tag = tags[tag_num]
       
       # Every data structure starts with "8BIM"
       out_str += "8BIM"
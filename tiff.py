@@ -17,27 +17,23 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 # 
 
-# Import local classes
-import ifd, exif, metainfofile, byteform, iptcnaa, convenience
-
-# Import python modules
+# Import standard Python modules
 import types
+# Import local classes
+import ifd, exif, metainfofile, byteform, iptcnaa, datablock
 
 class Tiff(metainfofile.MetaInfoFile):
-  def __init__(self, file_indicator, offset = 0):
-    """Initialize a Tiff file object. It needs an open file object or a path to
-    a file on the disk. A byte offset may be given to the start of the Tiff
-    header."""
+  def __init__(self, file_indicator, offset = 0, use_mmap = False):
+    """Initialize a Tiff file object. It needs an open file object, a path to
+    a file on the disk, or the file contents as buffer, bytearray or memoryview.
+    A byte offset may be given to the start of the Tiff header. If use_mmap is
+    True, a file is memory mapped and parsed from the mapping instead of by
+    reading from the file."""
     
     metainfofile.MetaInfoFile.__init__(self)
     
-    # Initialize the file pointer
-    if (type(file_indicator) == types.StringType):
-      self.fp = convenience.PersistentFileHandle(file_indicator, "rb")
-    elif isinstance(file_indicator, convenience.PersistentFileHandle):
-      self.fp = file_indicator
-    else:
-      raise "No valid file parameter given -- file path or file object needed." 
+    # Initialize the file pointer or data buffer
+    self.__openFile__(file_indicator, use_mmap)
     
     self.offset = offset
     
@@ -48,10 +44,10 @@ class Tiff(metainfofile.MetaInfoFile):
     """Parse the header of the Tiff file, starting ot the byte offset."""
     
     is_tiff = False
-    self.fp.seek(self.offset)
+    header  = datablock.DataBlock(offset = self.offset, **self.__getDataSource__())
     
     # Read the header
-    data = self.fp.read(2)
+    data = header.read(2)
     if (data == "MM"):
       self.big_endian = True
       is_tiff = True
@@ -60,7 +56,7 @@ class Tiff(metainfofile.MetaInfoFile):
       is_tiff = True
       
     # The next two bytes should be 42
-    if (is_tiff) and (byteform.btousi(self.fp.read(2), big_endian = self.big_endian) == 42):
+    if (is_tiff) and (byteform.btousi(header.read(2), big_endian = self.big_endian) == 42):
       is_tiff = True
       
     # If the file does not have a Tiff header, report it as false 
@@ -68,11 +64,11 @@ class Tiff(metainfofile.MetaInfoFile):
       raise "File is not Tiff"
     
     # Locate the Exif data
-    self.exif_offset = byteform.btousi(self.fp.read(4), big_endian = self.big_endian)
+    self.exif_offset = byteform.btousi(header.read(4), big_endian = self.big_endian)
     
   def loadExif(self):
     # Read the Exif data
-    self.exif = exif.Exif(self.exif_offset, self.offset, fp = self.fp, big_endian = self.big_endian)
+    self.exif = exif.Exif(self.exif_offset, self.offset, big_endian = self.big_endian, **self.__getDataSource__())
 
   def loadIPTC(self):
     # Get the IPTC block. The paylaod should simply be the encoded IPTC data
@@ -88,7 +84,7 @@ class Tiff(metainfofile.MetaInfoFile):
         iptc_tag = tiff_record.fields[33723]
         iptc_offset = iptc_tag.getDataOffset()
         #iptc_length = iptc_tag.getDataLength()
-        self.iptc = iptcnaa.IPTC(self.fp, iptc_offset) 
+        self.iptc = iptcnaa.IPTC(offset = iptc_offset, **self.__getDataSource__())
       except KeyError:
         pass
     
@@ -96,41 +92,78 @@ class Tiff(metainfofile.MetaInfoFile):
     if (self.iptc == None):
       self.iptc = iptcnaa.IPTC()
           
-  def writeFile(self, file_path):
-    # Write the header
-    out_fp = convenience.PersistentFileHandle(file_path, "wb")
-    if (self.big_endian):
-      out_fp.write("\x4d\x4d")
-    else:
-      out_fp.write("\x49\x49")
-    out_fp.write(byteform.itob(42, 2, big_endian = self.big_endian))
-    out_fp.write(byteform.itob(8, 4, big_endian = self.big_endian))
-    
+  def writeFile(self, file_path = None):
+    """ Write the file with the current metadata to the specified path or
+        writable file-like object, which doesn't need to be seekable. If the
+        path is None, the file is returned as string instead. """
+        
     # Embed the IPTC data in the Exif structure
     if (self.iptc):
-      self.exif.setTag(33723, self.iptc.getBlob(), record = 1)
+      self.__getExif__().setTag(33723, self.iptc.getBlob(), record = 1)
+      
+    # The main image is described by the Tiff IFD, but there may be more images
+    # in the SubIFD's
+    exif   = self.__getExif__()
+    images = [exif.getRecord(1)]
+    for index in range(exif.getNumSubIFDs()):
+      images.extend(exif.getSubIFDChain(index))
       
-    # Save the old strip offsets before we overwrite it
-    old_strip_offsets = self.__getExif__().getTag("StripOffsets", 1)
+    # Save the old strip offsets before we overwrite them
+    strips = []
+    for image in images:
+      strips.append([self.__getList__(image.getTag(273)), self.__getList__(image.getTag(279))]) # StripOffsets, StripByteCounts
 
     # Restructure the Exif metadata to contain the new strip offsets
-    curr_offset = self.exif.getSize() + 8 # 8 bytes for the Tiff header
-    tiff = self.exif.getRecord(1)
-    strip_lengths = self.exif.getTag("StripByteCounts", 1)
-    new_strip_offsets = []
-    for length in strip_lengths:
-      new_strip_offsets.append(curr_offset)
-      curr_offset += length
-    self.exif.setTag("StripOffsets", new_strip_offsets, 1)
+    curr_offset = exif.getSize(8) + 8 # 8 bytes for the Tiff header
+    for image_num in range(len(images)):
+      old_strip_offsets, strip_lengths = strips[image_num]
+      if (len(old_strip_offsets) == 0):
+        continue
+      new_strip_offsets = []
+      for length in strip_lengths:
+        new_strip_offsets.append(curr_offset)
+        curr_offset += length
+      # Keep the data type, so the size of the IFD doesn't change
+      data_type = images[image_num].fields[273].getDataType()
+      images[image_num].setTag(273, new_strip_offsets, data_type = data_type)
 
-    # Write the Exif data
-    out_fp.write(self.exif.getBlob(8))
+    # Encode the header and the Exif data, and restore the strip offsets, so
+    # the file can be written again
+    if (self.big_endian):
+      header = "\x4d\x4d"
+    else:
+      header = "\x49\x49"
+    header += byteform.itob(42, 2, big_endian = self.big_endian)
+    header += byteform.itob(8, 4, big_endian = self.big_endian)
+    header += exif.getBlob(8)
+    for image_num in range(len(images)):
+      if (len(strips[image_num][0]) > 0):
+        data_type = images[image_num].fields[273].getDataType()
+        images[image_num].setTag(273, strips[image_num][0], data_type = data_type)
+    
+    # Write the header and metadata at once
+    out_fp = self.__openOutput__(file_path)
+    out_fp.write(header)
     
     # Write the image data
-    for strip_num in range(len(strip_lengths)):
-      offset = old_strip_offsets[strip_num]
-      length = strip_lengths[strip_num]
-      self.fp.seek(offset)
-      out_fp.write(self.fp.read(length))
+    for old_strip_offsets, strip_lengths in strips:
+      for strip_num in range(len(old_strip_offsets)):
+        offset = old_strip_offsets[strip_num]
+        length = strip_lengths[strip_num]
+        # A DataBlock with length 0 would be copied up to the end of the file
+        if (length == 0):
+          continue
+        strip = datablock.DataBlock(offset = offset, length = length, **self.__getDataSource__())
+        strip.writeTo(out_fp)
       
-    out_fp.close()
+    return self.__closeOutput__(out_fp, file_path)
+
+  def __getList__(self, payload):
+    """ Return the payload of a tag which may hold one or more numbers as a
+        list. """
+        
+    if (type(payload) == types.ListType):
+      return payload
+    elif (payload == None) or (payload is False):
+      return []
+    return [payload]